@@ -0,0 +1,115 @@
+import os
+import asyncio
+import aiohttp
+import argparse
+
+import controller
+import poller
+import telemetry
+from utils import FrameSender, short_flags
+
+MODES = ("controller", "poller", "telemetry")
+
+
+async def run(args, modes):
+    """Run the given parts of the drone client on one event loop.
+
+    Parts running together pass commands and telemetry through in-memory
+    queues and share one HTTP connection pool; a part running alone talks
+    to the others over their Unix domain sockets instead.
+    """
+    token = os.environ.get("TOKEN")
+    command_queue = asyncio.Queue()
+    telemetry_queue = asyncio.Queue()
+    tasks = []
+
+    if "controller" in modes:
+        async def run_controller():
+            drone = await controller.connect(args.system)
+            await asyncio.gather(
+                controller.process_commands(drone, command_queue),
+                *controller.monitors(drone, telemetry_queue, args),
+            )
+
+        tasks.append(run_controller())
+        if "poller" not in modes:
+            tasks.append(controller.serve_commands(
+                args.command_socket, command_queue))
+        if "telemetry" not in modes:
+            json_queue = asyncio.Queue(maxsize=args.json_queue_size)
+            tasks.append(controller.queue_parser(telemetry_queue, json_queue))
+            tasks.append(controller.pub_telemetry(
+                args.telemetry_socket, json_queue))
+
+    session = None
+    if "poller" in modes or "telemetry" in modes:
+        # One connection for the long poll, the rest for uploads
+        limit = int("poller" in modes)
+        if "telemetry" in modes:
+            limit += args.max_in_flight
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=limit))
+
+    if "poller" in modes:
+        if "controller" in modes:
+            send = command_queue.put
+        else:
+            sender = FrameSender(args.command_socket)
+
+            async def send(command: str):
+                await sender.send(command.encode())
+        print(f"Polling {args.url}")
+        tasks.append(poller.run(session, args.url, token, send,
+                                args.on_error, args.wait))
+
+    if "telemetry" in modes:
+        uploader = telemetry.from_arguments(args, token)
+        if "controller" in modes:
+            source = uploader.read_queue(telemetry_queue)
+        else:
+            source = uploader.read_socket(args.telemetry_socket)
+        tasks.append(uploader.run(session, source))
+
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        if session is not None:
+            await session.close()
+
+
+def main(modes=None):
+    parser = argparse.ArgumentParser()
+    if modes is None:
+        # The flags depend on the parts, so pick those out first
+        selector = argparse.ArgumentParser(add_help=False)
+        selector.add_argument("--only", action="append", choices=MODES,
+                              help="part to run, repeat for several;"
+                                   " all of them by default")
+        parser = argparse.ArgumentParser(parents=[selector])
+        modes = selector.parse_known_args()[0].only or MODES
+
+    # A single part keeps the flags of its old standalone script
+    flag = short_flags(parser, len(modes) == 1)
+    if "poller" in modes or "telemetry" in modes:
+        flag("-u", "--url", default="http://localhost:5000")
+    if ("controller" in modes) != ("poller" in modes):
+        flag("-p", "--command_socket", default="./comms.sock")
+    if ("controller" in modes) != ("telemetry" in modes):
+        flag("-t" if "controller" in modes else "-p", "--telemetry_socket",
+             default="./tele.sock")
+    if "controller" in modes:
+        controller.add_arguments(parser, len(modes) == 1)
+    if "poller" in modes:
+        poller.add_arguments(parser, len(modes) == 1)
+    if "telemetry" in modes:
+        telemetry.add_arguments(parser, len(modes) == 1)
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(run(args, modes))
+    except KeyboardInterrupt:
+        print("\nShutting down...")
+
+
+if __name__ == "__main__":
+    main()
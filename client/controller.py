@@ -1,118 +1,152 @@
-import os
+import copy
 import json
-import errno
-import fcntl
 import asyncio
 import argparse
-from utils import makepipe
+from utils import frame, read_frame, serve_unix, short_flags
+from throttle import Throttle, position_changed, value_changed
 from mavsdk import System
 
 
-async def read_pipe(pipe_path: str, command_queue: asyncio.Queue):
-    while True:
-        fd = os.open(pipe_path, os.O_RDONLY | os.O_NONBLOCK)
-        if fd < 0:
-            raise FileNotFoundError(pipe_path)
+async def serve_commands(socket_path: str, command_queue: asyncio.Queue):
+    """Accept command frames from the poller."""
+    async def handle(reader, writer):
         try:
-            data = os.read(fd, 1)
-        except BlockingIOError:
-            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(
-                fd, fcntl.F_GETFL) ^ os.O_NONBLOCK)
-            data = os.read(fd, 1)
-            await command_queue.put(data.decode().strip())
-        except Exception as e:
+            while True:
+                data = await read_frame(reader)
+                await command_queue.put(data.decode().strip())
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except ValueError as e:
             print(e)
         finally:
-            os.close(fd)
-            await asyncio.sleep(0.1)
+            writer.close()
+
+    server = await serve_unix(socket_path, handle)
+    async with server:
+        await server.serve_forever()
 
 
 async def queue_parser(telemetry_queue: asyncio.Queue, json_queue: asyncio.Queue):
     while True:
         msg = await telemetry_queue.get()
         msg = json.dumps(msg)
-        await json_queue.put(msg)
+        # The forwarder spools to disk, only keep a short backlog in memory
+        if json_queue.full():
+            json_queue.get_nowait()
+            json_queue.task_done()
+        json_queue.put_nowait(msg)
         telemetry_queue.task_done()
 
 
-async def pub_telemetry(pipe_path: str, json_queue: asyncio.Queue):
-    while True:
-        fd = None
-        if json_queue.empty():
-            await asyncio.sleep(0.5)
-            continue
+async def pub_telemetry(socket_path: str, json_queue: asyncio.Queue):
+    """Stream telemetry frames to every connected forwarder."""
+    writers = set()
+    connected = asyncio.Event()
+
+    async def handle(reader, writer):
+        writers.add(writer)
+        connected.set()
         try:
-            fd = os.open(pipe_path, os.O_WRONLY | os.O_NONBLOCK)
-            i = 0
-            while not json_queue.empty() and i < 100:
-                msg = json_queue.get_nowait()
-                os.write(fd, msg.encode())
-                os.write(fd, "\n".encode())
-                i += 1
-                json_queue.task_done()
-        except Exception as e:
-            if e.args[0] == errno.ENXIO:
-                await asyncio.sleep(0.5)
-                continue
-            print(e)
+            # Forwarders never send anything, this only notices them leave
+            await reader.read()
         finally:
-            if fd:
-                os.close(fd)
+            drop(writer)
+
+    def drop(writer):
+        writers.discard(writer)
+        writer.close()
+        if not writers:
+            connected.clear()
+
+    server = await serve_unix(socket_path, handle)
+    async with server:
+        while True:
+            # Hold the backlog in json_queue until a forwarder connects
+            await connected.wait()
+            msg = await json_queue.get()
+            batch = frame(msg.encode())
+            json_queue.task_done()
+            while not json_queue.empty() and len(batch) < 200:
+                batch += frame(json_queue.get_nowait().encode())
+                json_queue.task_done()
+
+            for writer in list(writers):
+                try:
+                    writer.writelines(batch)
+                    await writer.drain()
+                except ConnectionError:
+                    drop(writer)
 
 
-async def monitor_armed(drone: System, queue: asyncio.Queue):
+async def monitor_armed(drone: System, queue: asyncio.Queue,
+                        throttle: Throttle):
     """Monitor armed status."""
     async for msg in drone.telemetry.armed():
-        await queue.put({
-            "type": "armed",
-            "armed": msg
-        })
+        if throttle(msg):
+            await queue.put({
+                "type": "armed",
+                "armed": msg
+            })
 
 
-async def monitor_in_air(drone: System, queue: asyncio.Queue):
+async def monitor_in_air(drone: System, queue: asyncio.Queue,
+                         throttle: Throttle):
     """Monitor if drone is in the air"""
     async for msg in drone.telemetry.in_air():
-        await queue.put({
-            "type": "in_air",
-            "in_air": msg
-        })
+        if throttle(msg):
+            await queue.put({
+                "type": "in_air",
+                "in_air": msg
+            })
 
 
-async def monitor_position(drone: System, queue: asyncio.Queue):
+async def monitor_position(drone: System, queue: asyncio.Queue,
+                           throttle: Throttle):
     """Monitor drone telemetry and print position updates."""
     async for position in drone.telemetry.position():
-        await queue.put({
-            "type": "position",
-            "data": {
-                "latitude_deg": f"{position.latitude_deg:.6f}",
-                "longitude_deg": f"{position.longitude_deg:.6f}",
-                "relative_altitude_m": f"{position.relative_altitude_m:.6f}",
-            }
-        })
-
-
-async def monitor_battery(drone: System, queue: asyncio.Queue):
+        sample = (position.latitude_deg, position.longitude_deg,
+                  position.relative_altitude_m)
+        if throttle(sample):
+            await queue.put({
+                "type": "position",
+                "data": {
+                    "latitude_deg": round(sample[0], 7),
+                    "longitude_deg": round(sample[1], 7),
+                    "relative_altitude_m": round(sample[2], 3),
+                }
+            })
+
+
+async def monitor_battery(drone: System, queue: asyncio.Queue,
+                          throttle: Throttle):
     """Monitor drone battery status."""
+    # Every battery is its own stream
+    throttles = {}
     async for battery in drone.telemetry.battery():
-        await queue.put({
-            "type": "battery",
-            "data": {
-                "id": battery.id,
-                "remaining_percent": battery.remaining_percent,
-            }
-        })
-
-
-async def monitor_mode(drone: System, queue: asyncio.Queue):
+        if battery.id not in throttles:
+            throttles[battery.id] = copy.copy(throttle)
+        if throttles[battery.id](battery.remaining_percent):
+            await queue.put({
+                "type": "battery",
+                "data": {
+                    "id": battery.id,
+                    "remaining_percent": battery.remaining_percent,
+                }
+            })
+
+
+async def monitor_mode(drone: System, queue: asyncio.Queue,
+                       throttle: Throttle):
     """Monitor drone current flight mode."""
 
     async for mode in drone.telemetry.flight_mode():
-        await queue.put({
-            "type": "flight_mode",
-            "data": {
-                "mode": str(mode)
-            }
-        })
+        if throttle(mode):
+            await queue.put({
+                "type": "flight_mode",
+                "data": {
+                    "mode": str(mode)
+                }
+            })
 
 
 async def process_commands(drone: System, command_queue: asyncio.Queue):
@@ -133,52 +167,56 @@ async def process_commands(drone: System, command_queue: asyncio.Queue):
             print(f"Unknown command: {command}")
 
 
-async def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-p", "--command_pipe", default="./comms.pipe")
-    parser.add_argument("-t", "--telemetry_pipe", default="./tele.pipe")
-    parser.add_argument("-s", "--system", default="udp://:14540")
-    args = parser.parse_args()
-
-    makepipe(args.telemetry_pipe)
-    command_queue = asyncio.Queue()
-    telemetry_queue = asyncio.Queue()
-    json_queue = asyncio.Queue()
-
+def add_arguments(parser: argparse.ArgumentParser, short: bool = True):
+    flag = short_flags(parser, short)
+    flag("-s", "--system", default="udp://:14540")
+    flag("-q", "--json_queue_size", type=int, default=1000)
+    parser.add_argument("--position_rate", type=float, default=5,
+                        help="maximum position updates per second")
+    parser.add_argument("--min_distance", type=float, default=1.0,
+                        help="metres moved before a new position is sent")
+    parser.add_argument("--min_altitude", type=float, default=0.5,
+                        help="metres climbed before a new position is sent")
+    parser.add_argument("--battery_rate", type=float, default=1)
+    parser.add_argument("--min_percent", type=float, default=1.0,
+                        help="battery change before a new reading is sent")
+    flag("-k", "--keyframe", type=float, default=10,
+         help="seconds after which a value is resent anyway")
+
+
+async def connect(system_address: str) -> System:
     drone = System()
     print("Waiting for drone to connect...")
-    await drone.connect(system_address=args.system)
+    await drone.connect(system_address=system_address)
 
     async for state in drone.core.connection_state():
         if state.is_connected:
             print("Drone connected!")
             break
-
-    # Create concurrent tasks
-    tasks = [
-        asyncio.create_task(read_pipe(args.command_pipe, command_queue)),
-        asyncio.create_task(monitor_position(drone, telemetry_queue)),
-        asyncio.create_task(monitor_battery(drone, telemetry_queue)),
-        asyncio.create_task(monitor_mode(drone, telemetry_queue)),
-        asyncio.create_task(monitor_in_air(drone, telemetry_queue)),
-        asyncio.create_task(monitor_armed(drone, telemetry_queue)),
-        asyncio.create_task(process_commands(drone, command_queue)),
-        asyncio.create_task(queue_parser(
-            telemetry_queue, json_queue)),
-        asyncio.create_task(pub_telemetry(
-            args.telemetry_pipe, json_queue)),
+    return drone
+
+
+def monitors(drone: System, telemetry_queue: asyncio.Queue, args) -> list:
+    """Coroutines publishing every telemetry stream to ``telemetry_queue``."""
+    return [
+        monitor_position(drone, telemetry_queue, Throttle(
+            position_changed(args.min_distance, args.min_altitude),
+            args.position_rate, args.keyframe)),
+        monitor_battery(drone, telemetry_queue, Throttle(
+            value_changed(args.min_percent), args.battery_rate,
+            args.keyframe)),
+        monitor_mode(drone, telemetry_queue, Throttle(keyframe=args.keyframe)),
+        monitor_in_air(
+            drone, telemetry_queue, Throttle(keyframe=args.keyframe)),
+        monitor_armed(
+            drone, telemetry_queue, Throttle(keyframe=args.keyframe)),
     ]
 
-    try:
-        # Run all tasks concurrently
-        await asyncio.gather(*tasks)
-    except KeyboardInterrupt:
-        print("\nShutting down...")
-        # Cancel all tasks
-        for task in tasks:
-            task.cancel()
-        await asyncio.gather(*tasks, return_exceptions=True)
+
+def main():
+    from agent import main as agent_main
+    agent_main(["controller"])
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()
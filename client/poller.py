@@ -1,52 +1,81 @@
-import os
-from time import sleep
-import requests
+import asyncio
+import aiohttp
 import argparse
-from utils import makepipe
+from utils import short_flags
 
+COMMANDS = {
+    "land": "l",
+    "loiter": "h",
+    "rtl": "r",
+}
+# Longest wait before resending a command that could not be marked done
+MAX_BACKOFF = 30
 
-def poll(url, token, on_error="loiter"):
+
+async def poll(session, url, token, on_error="loiter", wait=0):
     try:
-        return requests.get(
+        async with session.get(
             f"{url}/fetch",
-            headers={"Authorization": "Bearer " + token}
-        ).json()
-    except requests.exceptions.ConnectionError:
+            params={"wait": str(wait)},
+            headers={"Authorization": "Bearer " + token},
+            timeout=aiohttp.ClientTimeout(total=wait + 10)
+        ) as res:
+            return await res.json()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
         print("Connection error")
         return {"done": False, "command": on_error}
 
 
-def mark_done(url, token, id):
-    return requests.post(
+async def mark_done(session, url, token, id):
+    async with session.post(
         f"{url}/done/{id}",
-        headers={"Authorization": "Bearer " + token}
-    ).json()
+        headers={"Authorization": "Bearer " + token},
+        timeout=aiohttp.ClientTimeout(total=10),
+        raise_for_status=True
+    ) as res:
+        return await res.json()
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-u", "--url", default="http://localhost:5000")
-    parser.add_argument("-p", "--pipe", default="./comms.pipe")
-    parser.add_argument("-e", "--on_error", default="loiter")
-    args = parser.parse_args()
-    print(f"Polling {args.url}")
-    token = os.environ.get("TOKEN")
-    makepipe(args.pipe)
+async def run(session, url, token, send, on_error="loiter", wait=5):
+    """Fetch commands and hand them to ``send`` until cancelled."""
+    backoff = 0
     while True:
-        sleep(0.1)
-        res = poll(args.url, token, args.on_error)
+        res = await poll(session, url, token, on_error, wait)
         print(res)
+        if wait == 0 or "id" not in res:
+            await asyncio.sleep(0.1)
         if res["done"]:
             continue
-        with open(args.pipe, 'w') as f:
-            if res["command"] == "land":
-                f.write("l")
-            elif res["command"] == "loiter":
-                f.write("h")
-            elif res["command"] == "rtl":
-                f.write("r")
+        command = COMMANDS.get(res["command"])
+        if command is not None:
+            try:
+                await send(command)
+            except OSError as e:
+                print(f"Controller unavailable: {e}")
+                await asyncio.sleep(1)
+                continue
         if "id" in res and res["id"] is not None:
-            mark_done(args.url, token, res["id"])
+            try:
+                await mark_done(session, url, token, res["id"])
+                backoff = 0
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                # The command is still pending and the next poll returns
+                # it right away: back off instead of resending it in a loop
+                backoff = min(backoff * 2 or 1, MAX_BACKOFF)
+                print(f"Connection error, retrying in {backoff}s")
+                await asyncio.sleep(backoff)
+
+
+def add_arguments(parser: argparse.ArgumentParser, short: bool = True):
+    flag = short_flags(parser, short)
+    flag("-e", "--on_error", default="loiter")
+    flag("-w", "--wait", type=float, default=5,
+         help="long-poll timeout in seconds, 0 to poll")
+
+
+def main():
+    from agent import main as agent_main
+    agent_main(["poller"])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,140 @@
+import os
+import mmap
+import struct
+
+MAGIC = b"CSPL"
+VERSION = 1
+HEADER = struct.Struct("<4sIQQQ")  # magic, version, capacity, head, tail
+HEADER_SIZE = 64
+LENGTH = struct.Struct("<I")
+WRAP = 0xFFFFFFFF
+
+
+class Spool:
+    """Fixed-size ring buffer of length-prefixed records in a mmap.
+
+    ``head`` and ``tail`` are logical byte offsets that only grow; the
+    physical position is the offset modulo ``capacity``. A record that does
+    not fit before the end of the ring is written at the start and the gap
+    is skipped, so offsets stay comparable and ``commit`` can never move
+    ``head`` backwards. When the ring is full the oldest records are evicted,
+    or with ``evict="newest"`` the incoming record is rejected.
+
+    With ``path=None`` the ring lives in anonymous memory and is lost on
+    exit; with a path it survives restarts and link outages.
+    """
+
+    def __init__(self, path: str = None, capacity: int = 16 * 1024 * 1024,
+                 evict: str = "oldest"):
+        self.capacity = capacity
+        self.evict = evict
+        self.evicted = 0
+        size = HEADER_SIZE + capacity
+
+        if path is None:
+            self.map = mmap.mmap(-1, size)
+            self._reset()
+            return
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fresh = os.fstat(fd).st_size != size
+            if fresh:
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        magic, version, stored_capacity, head, tail = \
+            HEADER.unpack_from(self.map, 0)
+        if fresh or magic != MAGIC or version != VERSION \
+                or stored_capacity != capacity or not head <= tail:
+            self._reset()
+        else:
+            self.head, self.tail = head, tail
+
+    def __len__(self):
+        """Bytes currently in use, including wrap gaps."""
+        return self.tail - self.head
+
+    def _reset(self):
+        self.head = self.tail = 0
+        self._save()
+
+    def _save(self):
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION,
+                         self.capacity, self.head, self.tail)
+
+    def _wrap(self, offset: int) -> int:
+        return offset - offset % self.capacity + self.capacity
+
+    def _read(self, offset: int):
+        """Return ``(payload, next_offset)`` for the record at ``offset``."""
+        pos = offset % self.capacity
+        if self.capacity - pos < LENGTH.size:
+            return self._read(self._wrap(offset))
+        length, = LENGTH.unpack_from(self.map, HEADER_SIZE + pos)
+        if length == WRAP:
+            return self._read(self._wrap(offset))
+        start = HEADER_SIZE + pos + LENGTH.size
+        return self.map[start:start + length], offset + LENGTH.size + length
+
+    def append(self, payload: bytes) -> bool:
+        """Add a record, evicting old ones if needed.
+
+        Returns ``False`` if the record was not stored.
+        """
+        needed = LENGTH.size + len(payload)
+        if needed > self.capacity:
+            self.evicted += 1
+            return False
+
+        offset = self.tail
+        pos = offset % self.capacity
+        if self.capacity - pos < needed:
+            offset = self._wrap(offset)
+
+        while offset + needed - self.head > self.capacity:
+            if self.evict == "newest":
+                self.evicted += 1
+                return False
+            if self.head >= self.tail:
+                self.head = offset
+                break
+            _, self.head = self._read(self.head)
+            self.evicted += 1
+
+        if offset != self.tail and self.capacity - pos >= LENGTH.size:
+            LENGTH.pack_into(self.map, HEADER_SIZE + pos, WRAP)
+        start = HEADER_SIZE + offset % self.capacity
+        LENGTH.pack_into(self.map, start, len(payload))
+        self.map[start + LENGTH.size:start + needed] = payload
+        self.tail = offset + needed
+        self._save()
+        return True
+
+    def read(self, offset: int, max_records: int):
+        """Return up to ``max_records`` payloads from ``offset`` on.
+
+        ``offset`` is clamped to ``head`` in case it was evicted. Returns the
+        payloads and the offset just past the last one.
+        """
+        offset = max(offset, self.head)
+        records = []
+        while offset < self.tail and len(records) < max_records:
+            payload, offset = self._read(offset)
+            records.append(payload)
+        return records, offset
+
+    def commit(self, offset: int):
+        """Release every record before ``offset``."""
+        if offset > self.head:
+            self.head = min(offset, self.tail)
+            self._save()
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
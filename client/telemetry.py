@@ -1,37 +1,213 @@
-import os
-import requests
+import json
+import time
+import asyncio
+import aiohttp
 import argparse
-from time import sleep
+from spool import Spool
+from utils import connect_unix, read_frame, short_flags
 
 
-def send_msg(url, msg="", token=""):
-    try:
-        return requests.post(f"{url}/telemetry", headers={
-            "Authorization": "Bearer " + token,
-            "Content-Type": "application/json"
-        }, data=msg)
-    except Exception as e:
-        print(e)
+class Uploader:
+    """Forward telemetry messages to the server in batches.
 
+    Messages from the controller are stamped and appended to a ``Spool`` ring
+    buffer, which is disk-backed when a path is given, so nothing waits on
+    the network and an outage costs disk space instead of memory. A drainer
+    reads batches of up to ``batch_size`` messages, or whatever arrived in
+    ``batch_interval`` seconds, in arrival order and posts them to
+    ``/telemetry/batch`` over a shared keep-alive session. When a backlog
+    built up it sends ``backfill_size`` messages per request instead.
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-p", "--pipe", default="./tele.pipe")
-    parser.add_argument("-u", "--url", default="http://localhost:5000")
-    args = parser.parse_args()
-
-    token = os.environ.get("TOKEN")
-    while True:
-        with open(args.pipe, "r") as f:
+    At most ``max_in_flight`` uploads run at once. Records are only released
+    from the spool once every batch before them was accepted; after a
+    failure the drainer waits ``retry_interval`` seconds and resends from
+    the oldest unacknowledged record. Resent points carry their original
+    timestamp, so the server overwrites rather than duplicates them.
+    """
+
+    def __init__(self, url, token, spool: Spool, batch_size=50,
+                 batch_interval=1.0, backfill_size=500, max_in_flight=4,
+                 retry_interval=5, timeout=10):
+        self.url = url
+        self.token = token
+        self.spool = spool
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.backfill_size = backfill_size
+        self.max_in_flight = max_in_flight
+        self.retry_interval = retry_interval
+        self.timeout = timeout
+        self.window = asyncio.Semaphore(max_in_flight)
+        self.session = None
+        self.cursor = spool.head
+        self.in_flight = []
+        self.failed = False
+        self.arrived = asyncio.Event()
+
+    async def read_socket(self, socket_path: str):
+        while True:
+            reader, writer = await connect_unix(socket_path)
             try:
-                i = 0
-                while i < 100:
-                    line = f.readline(2048)
-                    i += 1
-                    if line:
-                        send_msg(args.url, line, token)
-            except Exception as e:
+                while True:
+                    self.parse_line(await read_frame(reader))
+            except (asyncio.IncompleteReadError, ConnectionError):
+                print("Controller disconnected, reconnecting")
+            except ValueError as e:
                 print(e)
+            finally:
+                writer.close()
+
+    def parse_line(self, line: bytes):
+        try:
+            msg = json.loads(line)
+        except ValueError as e:
+            print(f"Invalid telemetry line: {e}")
+            return
+        self.add(msg)
+
+    def add(self, msg: dict):
+        msg.setdefault("time", time.time())
+        self.spool.append(json.dumps(msg).encode())
+        self.arrived.set()
+
+    async def read_queue(self, queue: asyncio.Queue):
+        """Take messages straight from a controller in the same process."""
+        while True:
+            self.add(await queue.get())
+            queue.task_done()
+
+    async def next_batch(self):
+        """Wait for records after the cursor and return a batch of them.
+
+        Returns ``None`` when an upload failed in the meantime.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None
+        while True:
+            self.arrived.clear()
+            if self.failed:
+                return None
+            records, end = self.spool.read(self.cursor, self.backfill_size)
+            if len(records) >= self.batch_size:
+                break
+            if records and deadline is None:
+                deadline = loop.time() + self.batch_interval
+            if deadline is not None and loop.time() >= deadline:
+                break
+            timeout = None if deadline is None else deadline - loop.time()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        self.cursor = end
+        return end, b"[" + b",".join(records) + b"]"
+
+    async def send_batch(self, batch: dict, body: bytes):
+        try:
+            async with self.session.post(
+                f"{self.url}/telemetry/batch",
+                data=body,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={
+                    "Authorization": "Bearer " + self.token,
+                    "Content-Type": "application/json"
+                }
+            ) as res:
+                if res.status == 200:
+                    batch["done"] = True
+                else:
+                    print(f"Upload failed: {res.status} {await res.text()}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Upload failed: {e!r}")
+        finally:
+            if not batch["done"]:
+                self.failed = True
+                self.arrived.set()
+            self.acknowledge()
+            self.window.release()
+
+    def acknowledge(self):
+        """Release the leading run of accepted batches from the spool."""
+        while self.in_flight and self.in_flight[0]["done"]:
+            self.spool.commit(self.in_flight.pop(0)["end"])
+
+    async def run_uploads(self):
+        while True:
+            if self.failed:
+                # Let the other uploads settle, then resend what is left
+                for _ in range(self.max_in_flight):
+                    await self.window.acquire()
+                self.in_flight.clear()
+                self.cursor = self.spool.head
+                self.failed = False
+                await asyncio.sleep(self.retry_interval)
+                for _ in range(self.max_in_flight):
+                    self.window.release()
+
+            batch = await self.next_batch()
+            if batch is None:
+                continue
+            end, body = batch
+            await self.window.acquire()
+            if self.failed:
+                self.window.release()
+                continue
+            batch = {"end": end, "done": False}
+            self.in_flight.append(batch)
+            asyncio.create_task(self.send_batch(batch, body))
+
+    async def maintain_spool(self, interval=10):
+        while True:
+            await asyncio.sleep(interval)
+            self.spool.flush()
+            if self.spool.evicted:
+                print(f"Evicted {self.spool.evicted} telemetry messages")
+                self.spool.evicted = 0
+
+    async def run(self, session: aiohttp.ClientSession, source):
+        """Upload over ``session`` what the ``source`` coroutine feeds in."""
+        self.session = session
+        try:
+            await asyncio.gather(
+                source,
+                self.run_uploads(),
+                self.maintain_spool(),
+            )
+        finally:
+            self.spool.close()
+
+
+def add_arguments(parser: argparse.ArgumentParser, short: bool = True):
+    flag = short_flags(parser, short)
+    flag("-b", "--batch_size", type=int, default=50)
+    flag("-i", "--batch_interval", type=float, default=1.0)
+    flag("-f", "--backfill_size", type=int, default=500)
+    flag("-w", "--max_in_flight", type=int, default=4)
+    flag("-r", "--retry_interval", type=float, default=5)
+    flag("-t", "--timeout", type=float, default=10)
+    flag("-s", "--spool", default="./tele.spool",
+         help="spool file, empty to keep it in memory")
+    flag("-m", "--spool_size", type=int, default=64 * 1024 * 1024,
+         help="spool size in bytes")
+    flag("-d", "--drop", choices=["oldest", "newest"], default="oldest",
+         help="what to evict when full")
+
+
+def from_arguments(args, token: str) -> Uploader:
+    spool = Spool(args.spool or None, args.spool_size, args.drop)
+    return Uploader(args.url, token, spool,
+                    batch_size=args.batch_size,
+                    batch_interval=args.batch_interval,
+                    backfill_size=args.backfill_size,
+                    max_in_flight=args.max_in_flight,
+                    retry_interval=args.retry_interval,
+                    timeout=args.timeout)
+
+
+def main():
+    from agent import main as agent_main
+    agent_main(["telemetry"])
 
 
 if __name__ == "__main__":
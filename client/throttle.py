@@ -0,0 +1,63 @@
+import math
+import time
+
+EARTH_RADIUS = 6_371_000  # metres
+
+
+def distance(a: tuple, b: tuple) -> float:
+    """Approximate ground distance in metres between two (lat, lon)."""
+    lat = math.radians((a[0] + b[0]) / 2)
+    dx = math.radians(b[1] - a[1]) * math.cos(lat)
+    dy = math.radians(b[0] - a[0])
+    return EARTH_RADIUS * math.hypot(dx, dy)
+
+
+def position_changed(min_distance: float, min_altitude: float):
+    """Deadband for ``(lat, lon, alt)`` samples."""
+    def changed(last, value):
+        return distance(last, value) >= min_distance \
+            or abs(value[2] - last[2]) >= min_altitude
+    return changed
+
+
+def value_changed(threshold: float):
+    """Deadband for a single number."""
+    def changed(last, value):
+        return abs(value - last) >= threshold
+    return changed
+
+
+def state_changed(last, value):
+    return value != last
+
+
+class Throttle:
+    """Decide which samples of a telemetry stream are worth publishing.
+
+    A sample goes out when it differs from the last published one
+    according to ``changed``, but never more than ``rate`` times per
+    second. Whatever the value, one is sent at least every ``keyframe``
+    seconds so the server always has a fresh reading. Comparing against
+    the last published sample rather than the previous one means slow
+    drift still crosses the deadband eventually.
+    """
+
+    def __init__(self, changed=state_changed, rate: float = None,
+                 keyframe: float = 10.0):
+        self.changed = changed
+        self.interval = 1 / rate if rate else 0
+        self.keyframe = keyframe
+        self.last = None
+        self.last_at = None
+
+    def __call__(self, value, now: float = None) -> bool:
+        now = time.monotonic() if now is None else now
+        if self.last_at is not None:
+            elapsed = now - self.last_at
+            if elapsed < self.interval:
+                return False
+            if elapsed < self.keyframe and not self.changed(self.last, value):
+                return False
+        self.last = value
+        self.last_at = now
+        return True
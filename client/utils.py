@@ -1,11 +1,80 @@
 import os
+import struct
+import asyncio
 
+# Messages between the client processes travel over Unix domain sockets as
+# frames: a 4 byte big-endian length followed by the payload.
+HEADER = struct.Struct(">I")
+MAX_FRAME = 1024 * 1024
 
-def makepipe(name):
+
+def frame(payload: bytes) -> list:
+    """Header and payload as separate buffers, for vectored writes."""
+    return [HEADER.pack(len(payload)), payload]
+
+
+async def read_frame(reader: asyncio.StreamReader) -> bytes:
+    header = await reader.readexactly(HEADER.size)
+    length, = HEADER.unpack(header)
+    if length > MAX_FRAME:
+        raise ValueError(f"Frame of {length} bytes is too large")
+    return await reader.readexactly(length)
+
+
+async def serve_unix(path: str, handler):
+    """Listen on ``path``, replacing a socket left by a previous run."""
     try:
-        os.mkfifo(name)
-    except FileExistsError:
+        os.unlink(path)
+    except FileNotFoundError:
         pass
-    except OSError:
-        print("Failed to create pipe")
-        exit(1)
+    return await asyncio.start_unix_server(handler, path)
+
+
+async def connect_unix(path: str, retry: float = 1.0):
+    """Connect to ``path``, waiting for the server to come up."""
+    while True:
+        try:
+            return await asyncio.open_unix_connection(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            await asyncio.sleep(retry)
+
+
+class FrameSender:
+    """Frame writer that reconnects when the server restarts."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.writer = None
+
+    async def send(self, payload: bytes):
+        for attempt in range(2):
+            try:
+                if self.writer is None:
+                    _, self.writer = await asyncio.open_unix_connection(
+                        self.path)
+                self.writer.writelines(frame(payload))
+                await self.writer.drain()
+                return
+            except OSError:
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def short_flags(parser, short: bool = True):
+    """``add_argument`` that drops the short option when ``short`` is false.
+
+    The standalone scripts keep their single letter flags, the agent
+    combines all of them and only accepts the long names.
+    """
+    def flag(letter, name, **kwargs):
+        if short:
+            parser.add_argument(letter, name, **kwargs)
+        else:
+            parser.add_argument(name, **kwargs)
+    return flag
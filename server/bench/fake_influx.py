@@ -0,0 +1,377 @@
+"""In-memory stand-in for the InfluxDB 2 write and query HTTP API.
+
+It understands the line protocol the ``influxdb_client`` write API sends
+and the handful of Flux shapes ``InfluxStorage`` issues (range, filters on
+measurement, drone and time, last, aggregateWindow with last, drop,
+pivot, lat/lon filters, group and sort), answering in annotated CSV. Anything
+else in a query is ignored. ``--latency`` adds a fixed delay to every
+request to mimic a remote database.
+
+    python -m bench.fake_influx --port 8086
+"""
+import argparse
+import bisect
+import json
+import re
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PRECISION = {"s": 10**9, "ms": 10**6, "us": 10**3, "ns": 1}
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def _split(text: str, sep: str) -> list:
+    """Split on ``sep`` outside quotes and backslash escapes."""
+    parts, current, quoted, i = [], [], False, 0
+    while i < len(text):
+        c = text[i]
+        if c == "\\" and i + 1 < len(text):
+            current.append(text[i:i + 2])
+            i += 2
+            continue
+        if c == '"':
+            quoted = not quoted
+        elif c == sep and not quoted:
+            parts.append("".join(current))
+            current = []
+            i += 1
+            continue
+        current.append(c)
+        i += 1
+    parts.append("".join(current))
+    return parts
+
+
+def _unescape(text: str) -> str:
+    return re.sub(r"\\(.)", r"\1", text)
+
+
+def _field_value(text: str):
+    if text.startswith('"'):
+        return _unescape(text[1:-1])
+    if text in ("t", "T", "true", "True", "TRUE"):
+        return True
+    if text in ("f", "F", "false", "False", "FALSE"):
+        return False
+    if text.endswith("i") or text.endswith("u"):
+        return int(text[:-1])
+    return float(text)
+
+
+def parse_line(line: str, precision: str = "ns"):
+    """``(measurement, tags, fields, time_ns)`` of a line protocol line."""
+    parts = [p for p in _split(line, " ") if p]
+    series = _split(parts[0], ",")
+    tags = dict(_unescape(t).split("=", 1) for t in series[1:])
+    fields = {}
+    for field in _split(parts[1], ","):
+        key, value = field.split("=", 1)
+        fields[_unescape(key)] = _field_value(value)
+    if len(parts) > 2:
+        stamp = int(parts[2]) * PRECISION[precision]
+    else:
+        stamp = time.time_ns()
+    return _unescape(series[0]), tags, fields, stamp
+
+
+class Store:
+    """Points by series, each series sorted by time."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (measurement, tags, field) -> ([time_ns], [value])
+        self._series = defaultdict(lambda: ([], []))
+
+    def write(self, body: str, precision: str = "ns") -> int:
+        count = 0
+        with self._lock:
+            for line in body.splitlines():
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                measurement, tags, fields, stamp = parse_line(line, precision)
+                tags = tuple(sorted(tags.items()))
+                for field, value in fields.items():
+                    times, values = self._series[(measurement, tags, field)]
+                    i = bisect.bisect_right(times, stamp)
+                    if i and times[i - 1] == stamp:
+                        values[i - 1] = value
+                    else:
+                        times.insert(i, stamp)
+                        values.insert(i, value)
+                    count += 1
+        return count
+
+    def select(self, measurements, drone_id, start_ns, after_ns,
+               stop_ns=None):
+        """Copies of the matching series, restricted to the time range."""
+        selected = []
+        with self._lock:
+            for (measurement, tags, field), (times, values) \
+                    in self._series.items():
+                if measurement not in measurements:
+                    continue
+                if drone_id is not None \
+                        and dict(tags).get("drone_id") != drone_id:
+                    continue
+                if after_ns is not None:
+                    lo = bisect.bisect_right(times, after_ns)
+                else:
+                    lo = bisect.bisect_left(times, start_ns)
+                hi = len(times) if stop_ns is None \
+                    else bisect.bisect_left(times, stop_ns)
+                if lo < hi:
+                    selected.append(((measurement, tags, field),
+                                     times[lo:hi], values[lo:hi]))
+        return selected
+
+
+def _time_arg(text: str, now_ns: int) -> int:
+    relative = re.fullmatch(r"-(\d+)([smhd])", text.strip())
+    if relative:
+        return now_ns - int(relative.group(1)) * UNITS[relative.group(2)] \
+            * 10**9
+    absolute = re.search(r'time\(v: "([^"]+)"\)', text)
+    if absolute:
+        value = datetime.fromisoformat(absolute.group(1).replace("Z", "+00:00"))
+        return int(value.timestamp() * 10**9)
+    raise ValueError(f"Unsupported time {text!r}")
+
+
+def run_query(store: Store, flux: str) -> list:
+    """Evaluate ``flux`` roughly as InfluxDB would, returns tables of rows."""
+    now_ns = time.time_ns()
+    start = re.search(r"range\(start: (.*)\)\s*$", flux, re.M)
+    start_ns = _time_arg(start.group(1), now_ns) if start else 0
+    after = re.search(r'r\["_time"\] > (time\(v: "[^"]+"\))', flux)
+    after_ns = _time_arg(after.group(1), now_ns) if after else None
+    stop = re.search(r'stop: (time\(v: "[^"]+"\))', flux)
+    stop_ns = _time_arg(stop.group(1), now_ns) if stop else None
+
+    measurement = re.search(r'r\["_measurement"\] == "([^"]+)"', flux)
+    if measurement:
+        measurements = {measurement.group(1)}
+    else:
+        contained = re.search(
+            r'contains\(value: r\["_measurement"\], set: (\[.*?\])\)', flux)
+        measurements = set(json.loads(contained.group(1))) if contained \
+            else set()
+    drone = re.search(r'r\["drone_id"\] == "([^"]*)"', flux)
+    series = store.select(measurements, drone.group(1) if drone else None,
+                          start_ns, after_ns, stop_ns)
+
+    dropped = re.search(r"drop\(columns: (\[.*?\])\)", flux)
+    dropped = json.loads(dropped.group(1)) if dropped else []
+    if dropped:
+        # Series left with the same tags merge into one, in time order
+        merged = defaultdict(list)
+        for (measurement, tags, field), times, values in series:
+            tags = tuple((k, v) for k, v in tags if k not in dropped)
+            merged[(measurement, tags, field)] += zip(times, values)
+        series = []
+        for key, points in merged.items():
+            points.sort(key=lambda point: point[0])
+            series.append((key, [t for t, _ in points],
+                           [v for _, v in points]))
+
+    window = re.search(r"aggregateWindow\(every: (\d+)([smh])", flux)
+    if window:
+        every = int(window.group(1)) * UNITS[window.group(2)] * 10**9
+        windowed = []
+        for key, times, values in series:
+            last = {}
+            for stamp, value in zip(times, values):
+                # Influx stamps each window with its end
+                last[(stamp // every + 1) * every] = value
+            windowed.append((key, list(last), list(last.values())))
+        series = windowed
+    if "|> last()" in flux:
+        series = [(key, times[-1:], values[-1:])
+                  for key, times, values in series]
+
+    bounds = {"_start": start_ns, "_stop": stop_ns or now_ns}
+    if "pivot(" in flux:
+        rows = {}
+        for (measurement, tags, field), times, values in series:
+            for stamp, value in zip(times, values):
+                row = rows.setdefault((measurement, tags, stamp), {
+                    **bounds, "_time": stamp, "_measurement": measurement,
+                    **dict(tags)})
+                row[field] = value
+        rows = list(rows.values())
+        for column, op, bound in re.findall(
+                r"r\.(latitude|longitude) ([<>]=) (-?[\d.e+-]+)", flux):
+            bound = float(bound)
+            rows = [row for row in rows if column in row and (
+                row[column] >= bound if op == ">=" else row[column] <= bound)]
+        group = ["_measurement", "drone_id", "cell", "region", "battery_id"]
+    else:
+        rows = [{**bounds, "_time": stamp, "_value": value, "_field": field,
+                 "_measurement": measurement, **dict(tags)}
+                for (measurement, tags, field), times, values in series
+                for stamp, value in zip(times, values)]
+        group = ["_measurement", "_field", "drone_id", "cell", "region",
+                 "battery_id"]
+
+    group = [c for c in group if c not in dropped]
+
+    regroup = re.search(r"group\((?:columns: (\[.*?\]))?\)", flux)
+    if regroup:
+        group = json.loads(regroup.group(1)) if regroup.group(1) else []
+        if regroup.group(1) and "|> last()" in flux:
+            # last() runs after the regroup here, keep one row per group
+            newest = {}
+            for row in rows:
+                key = tuple(row.get(c) for c in group)
+                if key not in newest or newest[key]["_time"] < row["_time"]:
+                    newest[key] = row
+            rows = list(newest.values())
+
+    tables = defaultdict(list)
+    for row in rows:
+        tables[tuple(row.get(c) for c in group)].append(row)
+    desc = re.search(r'sort\(columns: \["_time"\], desc: true\)', flux)
+    for table in tables.values():
+        table.sort(key=lambda row: row["_time"], reverse=bool(desc))
+    return [(group, table) for table in tables.values()]
+
+
+def _format_time(stamp: int) -> str:
+    return datetime.fromtimestamp(stamp / 10**9, timezone.utc) \
+        .strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def _datatype(column: str, value) -> str:
+    if column in ("_start", "_stop", "_time"):
+        return "dateTime:RFC3339"
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, int):
+        return "long"
+    if isinstance(value, float):
+        return "double"
+    return "string"
+
+
+def _cell(column: str, value) -> str:
+    if value is None:
+        return ""
+    if column in ("_start", "_stop", "_time"):
+        return _format_time(value)
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    text = str(value)
+    if any(c in text for c in ',"\n'):
+        text = '"' + text.replace('"', '""') + '"'
+    return text
+
+
+def to_csv(tables: list) -> str:
+    """Annotated CSV with one header block per table."""
+    blocks = []
+    for index, (group, rows) in enumerate(tables):
+        columns = []
+        for row in rows:
+            columns += [c for c in row if c not in columns]
+        sample = {c: next((r[c] for r in rows if r.get(c) is not None), None)
+                  for c in columns}
+        lines = [
+            "#datatype,string,long," + ",".join(
+                _datatype(c, sample[c]) for c in columns),
+            "#group,false,false," + ",".join(
+                "true" if c in group else "false" for c in columns),
+            "#default,_result,," + "," * (len(columns) - 1),
+            ",result,table," + ",".join(columns),
+        ]
+        for row in rows:
+            lines.append(f",,{index}," + ",".join(
+                _cell(c, row.get(c)) for c in columns))
+        blocks.append("\r\n".join(lines) + "\r\n")
+    return "\r\n".join(blocks)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    store = None
+    latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, body: bytes = b"",
+               content_type: str = "application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self) -> str:
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length).decode()
+
+    def do_GET(self):
+        if self.path.startswith(("/health", "/ping")):
+            self._reply(200, b'{"status": "pass"}')
+        else:
+            self._reply(404, b'{"code": "not found"}')
+
+    def do_POST(self):
+        path, _, query = self.path.partition("?")
+        params = dict(p.split("=", 1) for p in query.split("&") if "=" in p)
+        body = self._body()
+        if self.latency:
+            time.sleep(self.latency)
+
+        if path == "/api/v2/write":
+            try:
+                self.store.write(body, params.get("precision", "ns"))
+            except (ValueError, IndexError) as e:
+                message = json.dumps({"code": "invalid", "message": str(e)})
+                return self._reply(400, message.encode())
+            return self._reply(204)
+
+        if path == "/api/v2/query":
+            flux = json.loads(body)["query"] if body.startswith("{") else body
+            try:
+                tables = run_query(self.store, flux)
+            except (ValueError, AttributeError) as e:
+                message = json.dumps({"code": "invalid", "message": str(e)})
+                return self._reply(400, message.encode())
+            return self._reply(200, to_csv(tables).encode(),
+                               "text/csv; charset=utf-8")
+
+        self._reply(404, b'{"code": "not found"}')
+
+
+def serve(port: int = 8086, latency: float = 0.0,
+          host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Start the fake on a background thread and return the server."""
+    handler = type("StoreHandler", (Handler,),
+                   {"store": Store(), "latency": latency})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8086)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds added to every request")
+    args = parser.parse_args()
+    server = serve(args.port, args.latency, args.host)
+    print(f"Fake InfluxDB listening on {args.host}:{args.port}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
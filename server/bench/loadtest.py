@@ -0,0 +1,311 @@
+"""Load test for one server instance backed by the fake InfluxDB.
+
+Starts ``bench.fake_influx`` and the app under waitress, or uvicorn with
+``--server asgi``. It then simulates drones that post telemetry and poll
+``/fetch``, plus dashboards that poll ``/last/telemetry`` and
+``/telemetry?minutes=``. At the end it reports throughput and latency
+percentiles per route.
+
+    python -m bench.loadtest --drones 20 --dashboards 10 --duration 30
+
+Pass ``--url`` to load an already running server instead; it then needs
+``--token``, and InfluxDB is whatever that server points at.
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Recorder:
+    """Latencies and failures per route."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self, route: str, seconds: float, ok: bool):
+        with self._lock:
+            self.latencies.setdefault(route, []).append(seconds)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def summary(self, duration: float) -> dict:
+        summary = {}
+        for route, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            summary[route] = {
+                "requests": len(latencies),
+                "errors": self.errors.get(route, 0),
+                "rps": len(latencies) / duration,
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p95_ms": percentile(latencies, 95) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+                "max_ms": latencies[-1] * 1000,
+            }
+        return summary
+
+
+def percentile(ordered: list, p: float) -> float:
+    """Nearest-rank percentile of a sorted list."""
+    if not ordered:
+        return 0.0
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+class Client:
+    """Keep-alive HTTP connection that times every request."""
+
+    def __init__(self, url: str, recorder: Recorder, token: str = None):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.recorder = recorder
+        self.headers = {"Authorization": f"Bearer {token}"} if token else {}
+        self.conn = None
+
+    def request(self, route: str, method: str, path: str, body=None,
+                headers=None):
+        headers = {**self.headers, **(headers or {})}
+        if body is not None:
+            body = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+        start = time.perf_counter()
+        ok = False
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(
+                    self.host, self.port, timeout=30)
+            self.conn.request(method, path, body, headers)
+            res = self.conn.getresponse()
+            res.read()
+            ok = res.status < 400
+        except (OSError, http.client.HTTPException):
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+        self.recorder.add(route, time.perf_counter() - start, ok)
+
+
+def every(interval: float, stop: threading.Event, jitter: bool = True):
+    """Yield on a fixed schedule until ``stop`` is set.
+
+    Falling behind sends the next request right away rather than skipping
+    it, so a slow server shows up as latency and lower throughput.
+    """
+    due = time.monotonic() + (random.uniform(0, interval) if jitter else 0)
+    while not stop.is_set():
+        delay = due - time.monotonic()
+        if delay > 0 and stop.wait(delay):
+            return
+        yield
+        due += interval
+
+
+def drone(client: Client, drone_id: str, args, stop: threading.Event):
+    """Post telemetry at ``--rate`` Hz and poll for commands."""
+    lat = 19.4 + random.uniform(-0.2, 0.2)
+    lon = -99.1 + random.uniform(-0.2, 0.2)
+    heading = random.uniform(0, 2 * math.pi)
+    battery = 100.0
+    next_fetch = 0
+    # Battery every second, the discrete states every ten
+    per_second = max(round(args.rate), 1)
+    for tick, _ in enumerate(every(1 / args.rate, stop)):
+        lat += math.cos(heading) * 5e-5
+        lon += math.sin(heading) * 5e-5
+        heading += random.uniform(-0.1, 0.1)
+        client.request("POST /telemetry", "POST", "/telemetry", {
+            "type": "position",
+            "drone_id": drone_id,
+            "time": time.time(),
+            "data": {
+                "latitude_deg": round(lat, 7),
+                "longitude_deg": round(lon, 7),
+                "relative_altitude_m": round(random.uniform(20, 40), 3),
+            }
+        })
+        if tick % per_second == 0:
+            battery = max(battery - 0.05, 0)
+            client.request("POST /telemetry", "POST", "/telemetry", {
+                "type": "battery",
+                "drone_id": drone_id,
+                "data": {"id": 0, "remaining_percent": battery}
+            })
+        if tick % (per_second * 10) == 0:
+            client.request("POST /telemetry", "POST", "/telemetry", {
+                "type": "flight_mode",
+                "drone_id": drone_id,
+                "data": {"mode": "MISSION"}
+            })
+            client.request("POST /telemetry", "POST", "/telemetry", {
+                "type": "armed", "drone_id": drone_id, "armed": True})
+            client.request("POST /telemetry", "POST", "/telemetry", {
+                "type": "in_air", "drone_id": drone_id, "in_air": True})
+        if time.monotonic() >= next_fetch:
+            next_fetch = time.monotonic() + args.fetch_interval
+            client.request("GET /fetch", "GET",
+                           f"/fetch?drone_id={drone_id}&wait=0")
+
+
+def dashboard(client: Client, drone_ids: list, args, stop: threading.Event):
+    """Poll the latest state every second and the track less often."""
+    drone_id = random.choice(drone_ids)
+    next_track = 0
+    for _ in every(args.poll_interval, stop):
+        client.request("GET /last/telemetry", "GET",
+                       f"/last/telemetry?drone_id={drone_id}")
+        if time.monotonic() >= next_track:
+            next_track = time.monotonic() + args.track_interval
+            client.request("GET /telemetry?minutes=", "GET",
+                           f"/telemetry?minutes={args.minutes}"
+                           f"&drone_id={drone_id}")
+
+
+def wait_until_up(url: str, timeout: float = 30):
+    parts = urlsplit(url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port,
+                                              timeout=1)
+            conn.request("GET", "/health")
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def start_servers(args, workdir: str):
+    """Launch the fake InfluxDB and the app, returns (processes, token)."""
+    env = {
+        **os.environ,
+        "CONTAINER": "docker",
+        "DATABASE": os.path.join(workdir, "bench.sqlite"),
+        "INFLUXDB_URL": f"http://127.0.0.1:{args.influx_port}",
+        "TELEMETRY_BACKEND": args.backend,
+        "EMBEDDED_STORAGE_PATH": os.path.join(workdir, "telemetry"),
+        "PYTHONPATH": SERVER_DIR,
+    }
+    influx = subprocess.Popen(
+        [sys.executable, "-m", "bench.fake_influx",
+         "--port", str(args.influx_port), "--latency", str(args.influx_latency)],
+        cwd=SERVER_DIR, env=env, stdout=subprocess.DEVNULL)
+    flask = [sys.executable, "-m", "flask", "--app", "cherum"]
+    subprocess.run(flask + ["db:create"], cwd=SERVER_DIR, env=env,
+                   check=True, stdout=subprocess.DEVNULL)
+    token = subprocess.run(flask + ["jwt:create"], cwd=SERVER_DIR, env=env,
+                           check=True, capture_output=True,
+                           text=True).stdout.strip()
+    if args.server == "asgi":
+        env["ASGI_THREADS"] = str(args.threads)
+        serve = ["uvicorn", f"--port={args.port}", "--log-level=warning",
+                 "--factory", "cherum.asgi:create_asgi_app"]
+    else:
+        serve = ["waitress", f"--port={args.port}",
+                 f"--threads={args.threads}", "--call", "cherum:create_app"]
+    app = subprocess.Popen([sys.executable, "-m"] + serve,
+                           cwd=SERVER_DIR, env=env, stderr=subprocess.DEVNULL)
+    return [app, influx], token
+
+
+def report(summary: dict, duration: float):
+    print(f"\n{'route':<26}{'requests':>9}{'errors':>8}{'req/s':>9}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for route, stats in summary.items():
+        print(f"{route:<26}{stats['requests']:>9}{stats['errors']:>8}"
+              f"{stats['rps']:>9.1f}{stats['p50_ms']:>9.1f}"
+              f"{stats['p95_ms']:>9.1f}{stats['p99_ms']:>9.1f}"
+              f"{stats['max_ms']:>9.1f}")
+    total = sum(stats['requests'] for stats in summary.values())
+    print(f"\n{total} requests in {duration:.1f}s, {total / duration:.1f} req/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--drones", type=int, default=10)
+    parser.add_argument("-m", "--dashboards", type=int, default=5)
+    parser.add_argument("-d", "--duration", type=float, default=30)
+    parser.add_argument("--rate", type=float, default=5,
+                        help="position messages per second per drone")
+    parser.add_argument("--fetch_interval", type=float, default=1)
+    parser.add_argument("--poll_interval", type=float, default=1,
+                        help="seconds between /last/telemetry polls")
+    parser.add_argument("--track_interval", type=float, default=5,
+                        help="seconds between /telemetry?minutes= polls")
+    parser.add_argument("--minutes", type=int, default=10)
+    parser.add_argument("--url", help="load an already running server")
+    parser.add_argument("--token", help="JWT for --url")
+    parser.add_argument("--port", type=int, default=5088)
+    parser.add_argument("--server", choices=["waitress", "asgi"],
+                        default="waitress",
+                        help="serve with waitress or uvicorn")
+    parser.add_argument("--threads", type=int, default=32,
+                        help="worker threads for sync views")
+    parser.add_argument("--backend", choices=["influx", "embedded"],
+                        default="influx", help="telemetry storage backend")
+    parser.add_argument("--influx_port", type=int, default=18086)
+    parser.add_argument("--influx_latency", type=float, default=0.0,
+                        help="seconds the fake InfluxDB adds per request")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    processes = []
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            url, token = args.url, args.token
+            if url is None:
+                url = f"http://127.0.0.1:{args.port}"
+                processes, token = start_servers(args, workdir)
+            wait_until_up(url)
+
+            recorder = Recorder()
+            stop = threading.Event()
+            drone_ids = [f"bench-{i}" for i in range(args.drones)]
+            threads = [
+                threading.Thread(target=drone, daemon=True, args=(
+                    Client(url, recorder, token), drone_id, args, stop))
+                for drone_id in drone_ids
+            ] + [
+                threading.Thread(target=dashboard, daemon=True, args=(
+                    Client(url, recorder), drone_ids or ["default"], args,
+                    stop))
+                for _ in range(args.dashboards)
+            ]
+            print(f"{args.drones} drones and {args.dashboards} dashboards"
+                  f" against {url} for {args.duration:.0f}s")
+            started = time.monotonic()
+            for thread in threads:
+                thread.start()
+            stop.wait(args.duration)
+            stop.set()
+            for thread in threads:
+                thread.join()
+            duration = time.monotonic() - started
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+    summary = recorder.summary(duration)
+    report(summary, duration)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"duration": duration, "args": vars(args),
+                       "routes": summary}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
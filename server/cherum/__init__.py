@@ -1,10 +1,24 @@
-from cherum.telemetry_store import TelemetryStore
-from flask import Flask, render_template, request, redirect, jsonify
+from cherum.telemetry_store import TelemetryStore, parse_time, format_time
+from cherum.embedded_storage import EmbeddedStorage
+from cherum.pubsub import TelemetryBroker, Notifier
+from cherum.metrics import Registry
+from cherum.asgi import ASYNC_BODY
+from flask import Flask, Response, render_template, request, redirect, jsonify, g
+from werkzeug.utils import secure_filename
 import cherum.jwt as jwt
 import cherum.db as db
+import cherum.track as track
+import cherum.assets as assets
+import cherum.export as export
+from cherum.heartbeat import HeartbeatRegistry, compact_pings_command
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 import datetime
+import functools
+import json
 import os
 import asyncio
+import time
 
 central_mexico_utc_offset = datetime.timedelta(hours=-6)
 central_mexico_tz = datetime.timezone(central_mexico_utc_offset)
@@ -18,15 +32,39 @@ def create_app(test_config=None):
         SECRET_KEY='dev',
         APP_NAME='Cherum',
         DATABASE=os.path.join(app.instance_path, 'flaskr.sqlite'),
+        TELEMETRY_BACKEND='influx',
+        EMBEDDED_STORAGE_PATH=os.path.join(app.instance_path, 'telemetry'),
+        EMBEDDED_PARTITION_SECONDS=3600,
+        EMBEDDED_RETENTION_DAYS=30,
         INFLUXDB_URL='http://localhost:8086',
         INFLUXDB_TOKEN='dev',
         INFLUXDB_ORG='covenant',
         INFLUXDB_BUCKET='telemetry',
-        VIDEO_URL='http://localhost:8889/mystream/whep'
+        INFLUXDB_BATCH_SIZE=100,
+        INFLUXDB_FLUSH_INTERVAL=5,
+        INFLUXDB_MAX_BUFFER=100_000,
+        INFLUXDB_QUERY_WORKERS=8,
+        INFLUXDB_QUERY_TIMEOUT=2,
+        RECENT_AREA_SECONDS=3600,
+        TELEMETRY_CACHE_TTL=60,
+        EXPORT_WINDOW_SECONDS=3600,
+        VIDEO_URL='http://localhost:8889/mystream/whep',
+        TELEMETRY_BATCH_MAX=1000,
+        FETCH_MAX_WAIT=30,
+        HEARTBEAT_TIMEOUT=10,
+        HEARTBEAT_PERSIST_INTERVAL=30,
+        CONNECTION_RETENTION_DAYS=30,
+        STREAM_KEEPALIVE=15,
+        SQLITE_WORKERS=4,
+        ASGI_THREADS=32,
+        ASSETS_FOLDER=os.path.join(app.root_path, 'dist')
     )
     app.teardown_appcontext(db.close)
     app.cli.add_command(db.init_db_command)
+    app.cli.add_command(db.migrate_db_command)
     app.cli.add_command(jwt.create_token_command)
+    app.cli.add_command(compact_pings_command)
+    app.cli.add_command(assets.build_assets_command)
 
     run_in_container = os.environ.get("CONTAINER", None)
 
@@ -46,13 +84,103 @@ def create_app(test_config=None):
     except OSError:
         pass
 
+    # Bring a database created by an older release up to date, new ones
+    # are created by db:create
+    with app.app_context():
+        conn = db.get()
+        if conn.execute("SELECT 1 FROM sqlite_master"
+                        " WHERE type = 'table' AND name = 'commands'").fetchone():
+            db.migrate(conn)
+
+    metrics = Registry()
+    broker = TelemetryBroker(dumps=app.json.dumps)
+    # Local files instead of InfluxDB for small deployments
+    backend = None
+    if app.config['TELEMETRY_BACKEND'] == 'embedded':
+        backend = EmbeddedStorage(
+            app.config['EMBEDDED_STORAGE_PATH'],
+            partition=int(app.config['EMBEDDED_PARTITION_SECONDS']),
+            retention=float(app.config['EMBEDDED_RETENTION_DAYS']) * 86400)
     telemetry_store = TelemetryStore(
         url=app.config['INFLUXDB_URL'],
         token=app.config['INFLUXDB_TOKEN'],
         org=app.config['INFLUXDB_ORG'],
-        bucket=app.config['INFLUXDB_BUCKET']
+        bucket=app.config['INFLUXDB_BUCKET'],
+        broker=broker,
+        buffer_size=int(app.config['INFLUXDB_BATCH_SIZE']),
+        flush_interval=float(app.config['INFLUXDB_FLUSH_INTERVAL']),
+        max_buffer=int(app.config['INFLUXDB_MAX_BUFFER']),
+        query_workers=int(app.config['INFLUXDB_QUERY_WORKERS']),
+        query_timeout=float(app.config['INFLUXDB_QUERY_TIMEOUT']),
+        recent_area_seconds=float(app.config['RECENT_AREA_SECONDS']),
+        cache_ttl=float(app.config['TELEMETRY_CACHE_TTL']),
+        export_window=float(app.config['EXPORT_WINDOW_SECONDS']),
+        backend=backend,
+        metrics=metrics
+    )
+    last_ping_published = {"at": None}
+    commands = Notifier()
+    sqlite_seconds = metrics.histogram(
+        "cherum_sqlite_write_seconds",
+        "Time spent on SQLite writes, commit included.", ("statement",))
+    heartbeats = HeartbeatRegistry(
+        db.get,
+        timeout=float(app.config['HEARTBEAT_TIMEOUT']),
+        persist_interval=float(app.config['HEARTBEAT_PERSIST_INTERVAL']),
+        retention=float(app.config['CONNECTION_RETENTION_DAYS']),
+        write_seconds=sqlite_seconds
     )
-    app.teardown_appcontext(telemetry_store.close)
+    request_seconds = metrics.histogram(
+        "cherum_http_request_duration_seconds",
+        "Time to produce a response, streamed bodies excluded.",
+        ("method", "route", "status"))
+    requests_in_flight = metrics.gauge(
+        "cherum_http_requests_in_flight", "Requests being handled.")
+    fetch_waiting = metrics.gauge(
+        "cherum_fetch_waiting", "Pollers parked in a /fetch long poll.")
+    metrics.gauge("cherum_stream_subscribers",
+                  "Dashboards connected to /stream/telemetry.",
+                  collect=broker.subscriber_count)
+    metrics.gauge("cherum_drones_connected",
+                  "Drones that polled /fetch within HEARTBEAT_TIMEOUT.",
+                  collect=heartbeats.connected)
+    # Drain buffered points and connection sessions when the server exits
+    atexit.register(telemetry_store.close)
+
+    @atexit.register
+    def flush_heartbeats():
+        with app.app_context():
+            heartbeats.flush()
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+        requests_in_flight.inc()
+
+    @app.after_request
+    def record_latency(response):
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        request_seconds.observe(
+            time.perf_counter() - g.request_start,
+            (request.method, route, str(response.status_code)))
+        return response
+
+    @app.teardown_request
+    def end_request(e=None):
+        requests_in_flight.dec()
+
+    @app.route('/metrics')
+    def export_metrics():
+        return Response(metrics.render(), content_type=Registry.CONTENT_TYPE)
+
+    # Hashed static files from `assets:build`, referenced by the templates
+    # through `asset(name)`
+    manifest = assets.Manifest(app.config['ASSETS_FOLDER'])
+    app.jinja_env.globals['asset'] = manifest.url
+
+    @app.route('/assets/<path:filename>', endpoint='assets')
+    def serve_asset(filename):
+        return assets.send_asset(app.config['ASSETS_FOLDER'], filename)
 
     # a simple page that says hello
     @app.route('/health')
@@ -63,20 +191,9 @@ def create_app(test_config=None):
     def index():
         last_connection = "Never"
 
-        conn_q = db.get().execute(
-            "SELECT created_at FROM pings ORDER BY created_at DESC LIMIT 1"
-        ).fetchone()
-        if conn_q is not None:
-            last_connection = conn_q[0]
-            last_connection = datetime.datetime(
-                last_connection.year,
-                last_connection.month,
-                last_connection.day,
-                last_connection.hour,
-                last_connection.minute,
-                last_connection.second,
-                tzinfo=utc_tz
-            )
+        last_seen = heartbeats.last_seen()
+        if last_seen is not None:
+            last_connection = last_seen.replace(microsecond=0)
 
             inactivity = datetime.datetime.now(utc_tz) - last_connection
             if inactivity.seconds > 10:
@@ -88,20 +205,9 @@ def create_app(test_config=None):
 
     @app.route('/last/connection')
     def last_connection():
-        conn_q = db.get().execute(
-            "SELECT created_at FROM pings ORDER BY created_at DESC LIMIT 1"
-        ).fetchone()
-        if conn_q is not None:
-            last_connection = conn_q[0]
-            last_connection = datetime.datetime(
-                last_connection.year,
-                last_connection.month,
-                last_connection.day,
-                last_connection.hour,
-                last_connection.minute,
-                last_connection.second,
-                tzinfo=utc_tz
-            )
+        last_seen = heartbeats.last_seen(request.args.get('drone_id'))
+        if last_seen is not None:
+            last_connection = last_seen.replace(microsecond=0)
             return str(last_connection.astimezone(central_mexico_tz))
         return "Never"
 
@@ -109,39 +215,77 @@ def create_app(test_config=None):
     def command():
         command = request.form.get("command")
         if command:
-            db.get().execute(
-                "INSERT INTO commands (command, done) VALUES (?, ?)",
-                (command, 0)
-            )
-            db.get().commit()
+            with sqlite_seconds.time(("commands",)):
+                db.get().execute(
+                    "INSERT INTO commands (command, done) VALUES (?, ?)",
+                    (command, 0)
+                )
+                db.get().commit()
+            commands.notify()
         return redirect("/")
 
+    # SQLite calls of /fetch run on a pool living as long as the app, so
+    # its threads keep their connections from one request to the next.
+    # Each call gets its own app context, the thread's connection never
+    # lands in the request's g
+    sqlite_executor = ThreadPoolExecutor(
+        max_workers=int(app.config['SQLITE_WORKERS']),
+        thread_name_prefix="sqlite")
+
+    def latest_command():
+        with app.app_context():
+            return db.get().execute(
+                "SELECT * FROM commands ORDER BY created_at DESC, id DESC LIMIT 1"
+            ).fetchone()
+
+    def beat(drone_id: str, now: datetime.datetime) -> bool:
+        with app.app_context():
+            return heartbeats.beat(drone_id, now)
+
     @app.route('/fetch')
-    def fetch():
+    async def fetch():
         if jwt.get_and_validate_token() is None:
             return {"error": "Unauthorized"}, 401
-        query = db.get().execute(
-            "SELECT * FROM commands ORDER BY created_at DESC LIMIT 1"
-        ).fetchone()
+        # Long-poll: park until a command is pending or `wait` seconds pass
+        wait = min(request.args.get('wait', 0, type=float),
+                   float(app.config['FETCH_MAX_WAIT']))
+        loop = asyncio.get_running_loop()
+        version = commands.version
+        query = await loop.run_in_executor(sqlite_executor, latest_command)
+        changed = False
+        if wait > 0 and (query is None or query[2]):
+            fetch_waiting.inc()
+            try:
+                changed = await commands.wait_async(version, wait)
+            finally:
+                fetch_waiting.dec()
+        if changed:
+            query = await loop.run_in_executor(sqlite_executor, latest_command)
         if query is None:
             response = {"id": None, "command": "", "done": 1}
         else:
             response = {"id": query[0], "command": query[1], "done": query[2]}
-        query = db.get().execute(
-            "INSERT INTO pings (created_at) VALUES (CURRENT_TIMESTAMP)"
-        )
-        db.get().commit()
+        now = datetime.datetime.now(utc_tz).replace(microsecond=0)
+        await loop.run_in_executor(
+            sqlite_executor, beat, request.args.get('drone_id', 'default'), now)
+
+        # Push connection updates to the dashboards at most once a second
+        if last_ping_published["at"] != now:
+            last_ping_published["at"] = now
+            broker.broadcast("connection",
+                             str(now.astimezone(central_mexico_tz)))
         return response
 
     @app.route('/done/<int:id>', methods=["POST"])
     def done(id):
         if jwt.get_and_validate_token() is None:
             return {"error": "Unauthorized"}, 401
-        db.get().execute(
-            "UPDATE commands SET done = 1 WHERE id = ?",
-            (id,)
-        )
-        db.get().commit()
+        with sqlite_seconds.time(("commands",)):
+            db.get().execute(
+                "UPDATE commands SET done = 1 WHERE id = ?",
+                (id,)
+            )
+            db.get().commit()
         return {"id": id}
 
     @app.route('/last/telemetry', methods=["GET"])
@@ -154,7 +298,12 @@ def create_app(test_config=None):
             asyncio.create_task(telemetry_store.last_armed(drone_id)),
             asyncio.create_task(telemetry_store.last_in_air(drone_id))
         ]
-        results = await asyncio.gather(*tasks)
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for i, result in enumerate(results):
+            # Answer with whatever succeeded rather than failing outright
+            if isinstance(result, Exception):
+                app.logger.error(f"Error querying last telemetry: {result}")
+                results[i] = None
         return {
             "position": results[0],
             "battery": results[1],
@@ -163,19 +312,100 @@ def create_app(test_config=None):
             "in_air": results[4]
         }
 
+    @app.route('/stream/telemetry', methods=["GET"])
+    def stream_telemetry():
+        drone_id = request.args.get('drone_id', 'default')
+        keepalive = float(app.config['STREAM_KEEPALIVE'])
+
+        def events():
+            sub = broker.subscribe(drone_id)
+            try:
+                yield b"retry: 2000\n\n"
+                while not sub.lagging:
+                    frame = sub.get(timeout=keepalive)
+                    yield frame if frame is not None else b": keepalive\n\n"
+            finally:
+                broker.unsubscribe(sub)
+
+        # Same stream without a thread per subscriber when served over ASGI
+        async def async_events():
+            sub = broker.subscribe(drone_id)
+            try:
+                yield b"retry: 2000\n\n"
+                while not sub.lagging:
+                    frame = await sub.get_async(timeout=keepalive)
+                    yield frame if frame is not None else b": keepalive\n\n"
+            finally:
+                broker.unsubscribe(sub)
+
+        body = async_events() if request.environ.get(ASYNC_BODY) else events()
+        return Response(body, mimetype="text/event-stream", headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        })
+
     @app.route('/telemetry', methods=["POST", "GET"])
     async def telemetry():
         if request.method == "GET":
             minutes = request.args.get('minutes', 10, type=int)
             drone_id = request.args.get('drone_id', 'default')
+            max_points = request.args.get('max_points', type=int)
+            resolution = request.args.get('resolution', type=int)
+            since = request.args.get('since')
+            # Compact columnar encoding when the client asks for it
+            compact = request.accept_mimetypes.best_match(
+                ["application/json", track.MIMETYPE]) == track.MIMETYPE
 
-            try:
-                positions = telemetry_store.query_recent_positions(
-                    minutes=minutes, drone_id=drone_id)
-                return jsonify(positions), 200
-            except Exception as e:
-                app.logger.error(f"Error querying telemetry: {e}")
-                return {"error": "Failed to query telemetry"}, 500
+            positions = None
+            if since is not None:
+                try:
+                    since = parse_time(since)
+                except ValueError:
+                    return {"error": "Invalid since cursor"}, 400
+
+                # Nothing newer was ingested: answer from the state cache
+                found, last = telemetry_store.last_state.lookup(
+                    drone_id, "position")
+                if found and (last is None or last['time'] <= since):
+                    if compact:
+                        positions = track.encode_track([], [], [], [])
+                        positions["cursor"] = format_time(since)
+                    else:
+                        positions = []
+
+            if positions is None:
+                query = telemetry_store.query_recent_track if compact \
+                    else telemetry_store.query_recent_positions
+                try:
+                    # Off the event loop, the read may block on the backend
+                    positions = await asyncio.get_running_loop().run_in_executor(
+                        telemetry_store.query_executor, functools.partial(
+                            query, minutes=minutes, drone_id=drone_id,
+                            max_points=max_points, resolution=resolution,
+                            since=since))
+                except Exception as e:
+                    app.logger.error(f"Error querying telemetry: {e}")
+                    return {"error": "Failed to query telemetry"}, 500
+
+            if compact:
+                cursor = parse_time(positions["cursor"])
+                response = app.response_class(
+                    app.json.dumps(positions), mimetype=track.MIMETYPE)
+            elif since is None:
+                response = jsonify(positions)
+            else:
+                # Incremental mode: only newer points plus the next cursor
+                cursor = max((p['time'] for p in positions), default=since)
+                response = jsonify({
+                    "positions": positions,
+                    "cursor": format_time(cursor)
+                })
+
+            response.vary.add("Accept")
+            if since is None:
+                return response
+            response.set_etag(format_time(cursor))
+            return response.make_conditional(request)
 
         if jwt.get_and_validate_token() is None:
             return {"error": "Unauthorized"}, 401
@@ -185,45 +415,112 @@ def create_app(test_config=None):
             return {"error": "Invalid telemetry data"}, 400
 
         try:
-            if telemetry_store:
-                drone_id = data.get('drone_id', 'default')
-
-                if data['type'] == 'position':
-                    pos_data = data['data']
-                    await telemetry_store.store_position(
-                        lat=float(pos_data['latitude_deg']),
-                        lon=float(pos_data['longitude_deg']),
-                        alt=float(pos_data['relative_altitude_m']),
-                        drone_id=drone_id
-                    )
-
-                elif data['type'] == 'battery':
-                    bat_data = data['data']
-                    await telemetry_store.store_battery(
-                        battery_id=bat_data['id'],
-                        percent=bat_data['remaining_percent'],
-                        drone_id=drone_id
-                    )
-
-                elif data['type'] == 'flight_mode':
-                    mode_data = data['data']
-                    await telemetry_store.store_flight_mode(
-                        mode=mode_data['mode'],
-                        drone_id=drone_id
-                    )
-
-                elif data['type'] == 'armed':
-                    armed = data['armed']
-                    await telemetry_store.store_armed(armed, drone_id)
-
-                elif data['type'] == 'in_air':
-                    in_air = data['in_air']
-                    await telemetry_store.store_in_air(in_air, drone_id)
-
+            await telemetry_store.store_message(data)
             return {"status": "received"}, 200
 
         except Exception as e:
             app.logger.error(f"Error storing telemetry: {e}")
             return {"error": "Failed to store telemetry"}, 500
 
+    @app.route('/fleet/last', methods=["GET"])
+    async def fleet_last():
+        max_age = request.args.get('max_age', type=float)
+        try:
+            drones = await telemetry_store.fleet_last(max_age)
+        except Exception as e:
+            app.logger.error(f"Error querying fleet telemetry: {e}")
+            return {"error": "Failed to query fleet telemetry"}, 500
+        return {"drones": drones}
+
+    @app.route('/positions/area', methods=["GET"])
+    def positions_in_area():
+        try:
+            bounds = {
+                key: float(request.args[key])
+                for key in ("min_lat", "max_lat", "min_lon", "max_lon")
+            }
+        except (KeyError, ValueError):
+            return {"error": "min_lat, max_lat, min_lon and max_lon "
+                             "are required numbers"}, 400
+        hours = request.args.get('hours', 24, type=float)
+
+        try:
+            positions = telemetry_store.query_positions_in_area(
+                hours=hours, **bounds)
+            return jsonify(positions), 200
+        except Exception as e:
+            app.logger.error(f"Error querying positions in area: {e}")
+            return {"error": "Failed to query positions"}, 500
+
+    @app.route('/export', methods=["GET"])
+    def export_flight_log():
+        drone_id = request.args.get('drone_id', 'default')
+        fmt = request.args.get('format', 'csv')
+        if fmt not in export.FORMATS:
+            return {"error": f"format must be one of {', '.join(export.FORMATS)}"}, 400
+        if fmt == 'parquet' and export.pyarrow is None:
+            return {"error": "Parquet export needs pyarrow installed"}, 501
+        measurements = request.args.get('measurements')
+        measurements = measurements.split(",") if measurements \
+            else list(export.MEASUREMENTS)
+        unknown = set(measurements) - set(export.MEASUREMENTS)
+        if unknown:
+            return {"error": f"Unknown measurements: {', '.join(sorted(unknown))}"}, 400
+        try:
+            start = parse_time(request.args['start'])
+            end = parse_time(request.args.get('end')) \
+                or datetime.datetime.now(utc_tz)
+        except KeyError:
+            return {"error": "start is required"}, 400
+        except ValueError:
+            return {"error": "Invalid start or end"}, 400
+        if start >= end:
+            return {"error": "start must be before end"}, 400
+
+        # Rows are read and written as the client downloads them
+        write, mimetype = export.FORMATS[fmt]
+        rows = telemetry_store.export(drone_id, measurements, start, end)
+        filename = secure_filename(
+            f"{drone_id}-{start.strftime('%Y%m%dT%H%M%SZ')}.{fmt}")
+        return Response(write(rows, measurements), mimetype=mimetype, headers={
+            "Content-Disposition": f'attachment; filename="{filename}"'
+        })
+
+    @app.route('/telemetry/batch', methods=["POST"])
+    async def telemetry_batch():
+        if jwt.get_and_validate_token() is None:
+            return {"error": "Unauthorized"}, 401
+
+        # Either a JSON array or one JSON message per line (NDJSON)
+        if request.mimetype == "application/json":
+            messages = request.get_json(silent=True)
+            if not isinstance(messages, list):
+                return {"error": "Expected a JSON array"}, 400
+        else:
+            messages = []
+            for line in request.get_data(as_text=True).splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    messages.append(json.loads(line))
+                except ValueError:
+                    messages.append(None)
+
+        if len(messages) > int(app.config['TELEMETRY_BATCH_MAX']):
+            return {"error": "Too many messages in batch"}, 413
+
+        drone_id = request.args.get('drone_id', 'default')
+        try:
+            statuses = await telemetry_store.store_batch(messages, drone_id)
+        except Exception as e:
+            app.logger.error(f"Error storing telemetry batch: {e}")
+            return {"error": "Failed to store telemetry"}, 500
+
+        received = sum(1 for status in statuses if "status" in status)
+        return {
+            "received": received,
+            "failed": len(statuses) - received,
+            "items": statuses
+        }, 200
+
     return app
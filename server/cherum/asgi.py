@@ -0,0 +1,247 @@
+"""ASGI entry point.
+
+Under a WSGI server every ``async def`` view runs on a throwaway event loop
+in a worker thread, so a request waiting on the database still holds a
+thread. Here async views run as tasks on the server's own event loop, next
+to each other and to ``TelemetryStore``'s query pool, and only hold a
+coroutine while they wait. Other views run on a pool of ``ASGI_THREADS``
+worker threads.
+
+    uvicorn --factory cherum.asgi:create_asgi_app --port 80
+"""
+import asyncio
+import inspect
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask
+from flask.signals import request_started
+from werkzeug.exceptions import HTTPException
+
+# Set in the WSGI environ of requests served here: views may answer with
+# an async iterable body, sent without holding a thread
+ASYNC_BODY = "cherum.async_body"
+
+_END = object()
+
+
+class AsgiApp:
+    """Serve a Flask app over ASGI, awaiting its async views on the loop."""
+
+    def __init__(self, app: Flask, threads: int = 32):
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_workers=threads,
+                                           thread_name_prefix="asgi-worker")
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope, receive, send):
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        environ = self._environ(scope, bytes(body))
+        if self._is_async(environ):
+            response = await self._dispatch(environ)
+        else:
+            response = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self._dispatch_sync, environ)
+        await self._respond(response, environ, receive, send)
+
+    @staticmethod
+    def _environ(scope, body: bytes) -> dict:
+        root_path = scope.get('root_path', '')
+        path = scope['path']
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        host, port = scope.get('server') or ('localhost', None)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': root_path.encode().decode('latin-1'),
+            'PATH_INFO': path.encode().decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': host,
+            'SERVER_PORT': str(port or 80),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.input_terminated': True,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            ASYNC_BODY: True,
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+            environ['REMOTE_PORT'] = str(scope['client'][1])
+        for name, value in scope['headers']:
+            key = name.decode('latin-1').upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = f"HTTP_{key}"
+            value = value.decode('latin-1')
+            if key in environ:
+                value = f"{environ[key]},{value}"
+            environ[key] = value
+        return environ
+
+    def _is_async(self, environ: dict) -> bool:
+        """Whether the request is routed to an ``async def`` view."""
+        if environ['REQUEST_METHOD'] == 'OPTIONS':
+            return False
+        try:
+            endpoint, _ = self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            # Flask answers redirects and routing errors
+            return False
+        return inspect.iscoroutinefunction(self.app.view_functions[endpoint])
+
+    def _dispatch_sync(self, environ: dict):
+        """``Flask.wsgi_app`` up to the response object."""
+        app = self.app
+        ctx = app.request_context(environ)
+        error = None
+        try:
+            try:
+                ctx.push()
+                return app.full_dispatch_request()
+            except Exception as e:
+                error = e
+                return app.handle_exception(e)
+            except BaseException:
+                error = sys.exc_info()[1]
+                raise
+        finally:
+            if error is not None and app.should_ignore_error(error):
+                error = None
+            ctx.pop(error)
+
+    async def _dispatch(self, environ: dict):
+        """``_dispatch_sync`` awaiting the view on the running loop."""
+        app = self.app
+        ctx = app.request_context(environ)
+        error = None
+        try:
+            try:
+                ctx.push()
+                return await self._full_dispatch(ctx.request)
+            except Exception as e:
+                error = e
+                return app.handle_exception(e)
+            except BaseException:
+                error = sys.exc_info()[1]
+                raise
+        finally:
+            if error is not None and app.should_ignore_error(error):
+                error = None
+            ctx.pop(error)
+
+    async def _full_dispatch(self, request):
+        app = self.app
+        app._got_first_request = True
+        try:
+            request_started.send(app, _async_wrapper=app.ensure_sync)
+            rv = app.preprocess_request()
+            if rv is None:
+                view = app.view_functions[request.url_rule.endpoint]
+                rv = await view(**request.view_args)
+        except Exception as e:
+            rv = app.handle_user_exception(e)
+        return app.finalize_request(rv)
+
+    async def _respond(self, response, environ: dict, receive, send):
+        app_iter, status, headers = response.get_wsgi_response(environ)
+        await send({
+            'type': 'http.response.start',
+            'status': int(status.split(" ", 1)[0]),
+            'headers': [(name.lower().encode('latin-1'),
+                         value.encode('latin-1'))
+                        for name, value in headers],
+        })
+
+        async_body = hasattr(response.response, '__aiter__')
+        empty = environ['REQUEST_METHOD'] == 'HEAD' \
+            or response.status_code in (204, 304) \
+            or response.status_code < 200
+        disconnect = asyncio.ensure_future(self._disconnected(receive))
+        try:
+            if async_body:
+                if not empty:
+                    await self._send_async(response.response, disconnect, send)
+            elif response.is_sequence:
+                for chunk in app_iter:
+                    await send({'type': 'http.response.body',
+                                'body': chunk, 'more_body': True})
+            else:
+                loop = asyncio.get_running_loop()
+                chunks = iter(app_iter)
+                while not disconnect.done():
+                    chunk = await loop.run_in_executor(
+                        self.executor, next, chunks, _END)
+                    if chunk is _END:
+                        break
+                    await send({'type': 'http.response.body',
+                                'body': chunk, 'more_body': True})
+            if not disconnect.done():
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnect.cancel()
+            aclose = getattr(response.response, 'aclose', None)
+            if async_body and aclose is not None:
+                await aclose()
+            app_iter.close()
+
+    @staticmethod
+    async def _send_async(body, disconnect: asyncio.Future, send):
+        """Send an async body until it ends or the client goes away."""
+        chunks = body.__aiter__()
+        while True:
+            pending = asyncio.ensure_future(chunks.__anext__())
+            await asyncio.wait({pending, disconnect},
+                               return_when=asyncio.FIRST_COMPLETED)
+            if not pending.done():
+                # Stop a stream parked waiting for its next event
+                pending.cancel()
+                await asyncio.wait({pending})
+                return
+            try:
+                chunk = pending.result()
+            except StopAsyncIteration:
+                return
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            await send({'type': 'http.response.body',
+                        'body': chunk, 'more_body': True})
+
+    @staticmethod
+    async def _disconnected(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+
+def create_asgi_app(test_config=None) -> AsgiApp:
+    """``create_app`` served over ASGI, for ``uvicorn --factory``."""
+    from cherum import create_app
+    app = create_app(test_config)
+    return AsgiApp(app, threads=int(app.config['ASGI_THREADS']))
@@ -0,0 +1,128 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import threading
+
+import click
+from flask import current_app, request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST = "manifest.json"
+# Other formats are compressed already
+COMPRESSIBLE = (".js", ".css", ".svg", ".html", ".json", ".txt", ".map")
+# Preferred first when the client accepts several equally
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+# Hashed names never change content, browsers can keep them for a year
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def hashed_name(name: str, data: bytes) -> str:
+    root, ext = os.path.splitext(name)
+    return f"{root}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+
+
+def _compressed(data: bytes):
+    yield ".gz", gzip.compress(data, 9, mtime=0)
+    if brotli is not None:
+        yield ".br", brotli.compress(data, quality=11)
+
+
+def build(source: str, target: str) -> dict:
+    """Copy the files of ``source`` to ``target`` under content hashed names.
+
+    Text files also get ``.gz`` and, with the ``brotli`` package installed,
+    ``.br`` variants when those are smaller. Returns the manifest of
+    original to hashed names, also written to ``target/manifest.json``.
+    """
+    shutil.rmtree(target, ignore_errors=True)
+    manifest = {}
+    for root, _, files in os.walk(source):
+        for file in sorted(files):
+            path = os.path.join(root, file)
+            name = os.path.relpath(path, source).replace(os.sep, "/")
+            with open(path, "rb") as f:
+                data = f.read()
+            hashed = manifest[name] = hashed_name(name, data)
+
+            out = os.path.join(target, hashed)
+            os.makedirs(os.path.dirname(out), exist_ok=True)
+            with open(out, "wb") as f:
+                f.write(data)
+            if not name.endswith(COMPRESSIBLE):
+                continue
+            for suffix, compressed in _compressed(data):
+                if len(compressed) < len(data):
+                    with open(out + suffix, "wb") as f:
+                        f.write(compressed)
+
+    with open(os.path.join(target, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+class Manifest:
+    """Hashed names of the built assets, reread when a build replaces them."""
+
+    def __init__(self, folder: str):
+        self.path = os.path.join(folder, MANIFEST)
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._names = {}
+
+    def get(self, name: str) -> str:
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        with self._lock:
+            if mtime != self._mtime:
+                self._names = {}
+                if mtime is not None:
+                    with open(self.path) as f:
+                        self._names = json.load(f)
+                self._mtime = mtime
+            return self._names.get(name)
+
+    def url(self, name: str) -> str:
+        """URL of a static file, the hashed build when there is one."""
+        hashed = self.get(name)
+        if hashed is None:
+            return url_for('static', filename=name)
+        return url_for('assets', filename=hashed)
+
+
+def send_asset(folder: str, filename: str):
+    """Serve a built asset in the best encoding the client accepts."""
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    encoding, suffix = None, ""
+    offered = [coding for coding, ext in ENCODINGS
+               if os.path.isfile(os.path.join(folder, filename + ext))]
+    best = request.accept_encodings.best_match(offered + ["identity"])
+    for coding, ext in ENCODINGS:
+        if coding == best:
+            encoding, suffix = coding, ext
+
+    response = send_from_directory(folder, filename + suffix,
+                                   mimetype=mimetype,
+                                   max_age=IMMUTABLE_MAX_AGE)
+    if encoding is not None:
+        response.content_encoding = encoding
+    response.vary.add("Accept-Encoding")
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@click.command('assets:build')
+def build_assets_command():
+    """Build hashed and compressed copies of the static files."""
+    manifest = build(current_app.static_folder,
+                     current_app.config['ASSETS_FOLDER'])
+    click.echo(f'Built {len(manifest)} assets.')
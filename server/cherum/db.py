@@ -1,15 +1,58 @@
 import sqlite3
+import threading
 from datetime import datetime
 
 import click
 from flask import current_app, g
 
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -8000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+)
+
+# Schema changes applied by `db:migrate`, tracked in PRAGMA user_version.
+# schema.sql always creates the latest schema.
+MIGRATIONS = (
+    """
+    CREATE TABLE IF NOT EXISTS connections (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      drone_id TEXT NOT NULL,
+      connected_at TIMESTAMP NOT NULL,
+      last_seen_at TIMESTAMP NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS connections_drone_last_seen
+      ON connections (drone_id, last_seen_at);
+    CREATE INDEX IF NOT EXISTS connections_last_seen
+      ON connections (last_seen_at);
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS commands_created_at
+      ON commands (created_at);
+    """,
+)
+
+# One connection per worker thread and database, reused across requests
+_local = threading.local()
+
 
 def init_db():
     db = get()
 
     with current_app.open_resource('schema.sql') as f:
         db.executescript(f.read().decode('utf8'))
+    db.execute(f"PRAGMA user_version = {len(MIGRATIONS)}")
+
+
+def migrate(db) -> int:
+    """Apply pending migrations, returns how many ran."""
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    for i, script in enumerate(MIGRATIONS[version:], start=version + 1):
+        db.executescript(script)
+        db.execute(f"PRAGMA user_version = {i}")
+    return len(MIGRATIONS) - min(version, len(MIGRATIONS))
 
 
 @click.command('db:create')
@@ -19,13 +62,31 @@ def init_db_command():
     click.echo('Initialized the database.')
 
 
+@click.command('db:migrate')
+def migrate_db_command():
+    """Upgrade an existing database to the current schema."""
+    count = migrate(get())
+    click.echo(f'Applied {count} migrations.')
+
+
+def _connect(path):
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    db = connections.get(path)
+    if db is None:
+        db = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+        db.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            db.execute(pragma)
+        connections[path] = db
+    return db
+
+
 def get():
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
+        g.db = _connect(current_app.config['DATABASE'])
 
     return g.db
 
@@ -33,8 +94,9 @@ def get():
 def close(e=None):
     db = g.pop('db', None)
 
-    if db is not None:
-        db.close()
+    # The connection stays open for the next request on this thread
+    if db is not None and db.in_transaction:
+        db.rollback()
 
 
 sqlite3.register_converter(
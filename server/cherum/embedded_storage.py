@@ -0,0 +1,352 @@
+import heapq
+import json
+import mmap
+import os
+import shutil
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+from datetime import datetime, timezone
+from urllib.parse import quote, unquote
+from cherum.storage import StorageBackend
+
+# Column type of every stored field and tag. Strings are dictionary
+# encoded: the column holds indexes into a per-segment list of values.
+SCHEMA = {
+    'position': {'latitude': 'd', 'longitude': 'd', 'altitude': 'd'},
+    'battery': {'battery_id': 'str', 'remaining_percent': 'd'},
+    'flight_mode': {'mode': 'str'},
+    'armed': {'armed': 'b'},
+    'in_air': {'in_air': 'b'},
+}
+
+
+def _ns(value: datetime) -> int:
+    return int(value.timestamp() * 1_000_000) * 1000
+
+
+def _datetime(ns: int) -> datetime:
+    return datetime.fromtimestamp(ns / 1e9, timezone.utc)
+
+
+def _dirname(drone_id: str) -> str:
+    return quote(drone_id, safe="").replace(".", "%2E")
+
+
+class Segment:
+    """One partition of a drone measurement, stored column by column.
+
+    Every column is an append-only file of fixed-width values, rows are
+    the same position in each file. Reads memory-map the files, so only
+    pages actually touched are loaded. A crash between column writes
+    leaves some files longer; readers only trust the shortest, and the
+    next append cuts the others back to it.
+    """
+
+    def __init__(self, path: str, columns: dict):
+        self.path = path
+        self.columns = columns
+        self._strings = {}
+        self._strings_lock = threading.Lock()
+
+    def _file(self, name: str) -> str:
+        code = self.columns.get(name, 'q')
+        return os.path.join(self.path, f"{name}.{code}")
+
+    def _dictionary(self, name: str) -> list:
+        """Known values of a string column, loaded once per segment."""
+        with self._strings_lock:
+            values = self._strings.get(name)
+            if values is None:
+                values = []
+                try:
+                    with open(os.path.join(self.path, f"{name}.dict")) as f:
+                        values = [json.loads(line) for line in f]
+                except FileNotFoundError:
+                    pass
+                self._strings[name] = values
+            return values
+
+    def _truncate(self):
+        """Drop values past the last row every column holds."""
+        sizes = {}
+        for name, code in {'time': 'q', **self.columns}.items():
+            width = array('i' if code == 'str' else code).itemsize
+            try:
+                size = os.path.getsize(self._file(name))
+            except FileNotFoundError:
+                size = 0
+            sizes[name] = (size, width)
+        count = min(size // width for size, width in sizes.values())
+        for name, (size, width) in sizes.items():
+            if size > count * width:
+                os.truncate(self._file(name), count * width)
+
+    def append(self, rows: list):
+        """Write ``(time_ns, values)`` rows, ``values`` keyed by column."""
+        os.makedirs(self.path, exist_ok=True)
+        # Otherwise these rows would line up with a torn earlier write
+        self._truncate()
+        for name, code in self.columns.items():
+            values = [row[1].get(name) for row in rows]
+            if code == 'str':
+                known = self._dictionary(name)
+                index = {value: i for i, value in enumerate(known)}
+                new = []
+                for value in values:
+                    if value not in index:
+                        index[value] = len(known) + len(new)
+                        new.append(value)
+                if new:
+                    # Entries land before any row can refer to them
+                    with self._strings_lock, open(os.path.join(
+                            self.path, f"{name}.dict"), "a") as f:
+                        f.writelines(json.dumps(v) + "\n" for v in new)
+                        known.extend(new)
+                column = array('i', (index[v] for v in values))
+            elif code == 'd':
+                column = array('d', (
+                    float('nan') if v is None else v for v in values))
+            else:
+                column = array(code, (bool(v) for v in values))
+            with open(self._file(name), "ab") as f:
+                column.tofile(f)
+        with open(self._file('time'), "ab") as f:
+            array('q', (row[0] for row in rows)).tofile(f)
+
+    def read(self, start_ns: int = None, after_ns: int = None,
+             newest: bool = False) -> list:
+        """Rows as ``(time_ns, values)`` oldest first.
+
+        A timestamp written twice keeps the latest write, like a series in
+        InfluxDB. With ``newest`` only the newest row is returned.
+        """
+        maps, views = [], {}
+        try:
+            for name, code in {'time': 'q', **self.columns}.items():
+                code = 'i' if code == 'str' else code
+                try:
+                    f = open(self._file(name), "rb")
+                except FileNotFoundError:
+                    return []
+                with f:
+                    size = os.fstat(f.fileno()).st_size
+                    # Ignore a value still being written
+                    size -= size % array(code).itemsize
+                    if size == 0:
+                        return []
+                    m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+                maps.append(m)
+                with memoryview(m) as view:
+                    views[name] = view.cast(code)
+            count = min(len(view) for view in views.values())
+
+            times = views['time']
+            latest = {}
+            for i in range(count):
+                t = times[i]
+                if (start_ns is None or t >= start_ns) \
+                        and (after_ns is None or t > after_ns):
+                    latest[t] = i
+            if not latest:
+                return []
+            stamps = [max(latest)] if newest else sorted(latest)
+
+            rows = []
+            for t in stamps:
+                i = latest[t]
+                values = {}
+                for name, code in self.columns.items():
+                    value = views[name][i]
+                    if code == 'str':
+                        value = self._dictionary(name)[value]
+                    elif code == 'b':
+                        value = bool(value)
+                    elif value != value:
+                        value = None
+                    values[name] = value
+                rows.append((t, values))
+            return rows
+        finally:
+            for view in views.values():
+                view.release()
+            for m in maps:
+                m.close()
+
+
+class EmbeddedStorage(StorageBackend):
+    """Telemetry kept in local files, with no database server.
+
+    Points are partitioned by measurement, drone and time window of
+    ``partition`` seconds into ``Segment`` directories under ``path``::
+
+        path/position/<drone>/<window start>/{time.q,latitude.d,...}
+
+    An in-memory index of the windows each drone has keeps queries to the
+    segments overlapping their time range. Segments entirely older than
+    ``retention`` seconds are deleted.
+    """
+
+    def __init__(self, path: str, partition: int = 3600,
+                 retention: float = 30 * 86400):
+        self.path = path
+        self.partition = int(partition)
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._segments = {}
+        # (measurement, drone) -> sorted window starts
+        self._index = defaultdict(list)
+        self._load_index()
+
+    def _load_index(self):
+        for measurement in SCHEMA:
+            root = os.path.join(self.path, measurement)
+            if not os.path.isdir(root):
+                continue
+            for drone in os.listdir(root):
+                windows = sorted(int(w) for w in os.listdir(
+                    os.path.join(root, drone)) if w.isdigit())
+                if windows:
+                    self._index[(measurement, unquote(drone))] = windows
+
+    def _segment(self, measurement: str, drone_id: str, window: int):
+        key = (measurement, drone_id, window)
+        segment = self._segments.get(key)
+        if segment is None:
+            path = os.path.join(self.path, measurement, _dirname(drone_id),
+                                str(window))
+            segment = self._segments[key] = Segment(path, SCHEMA[measurement])
+        return segment
+
+    def _windows(self, measurement: str, drone_id: str,
+                 start_ns: int, end_ns: int = None) -> list:
+        """Segments of a drone measurement that may hold rows since start."""
+        with self._lock:
+            windows = self._index.get((measurement, drone_id), [])
+            first = start_ns // 1_000_000_000 - self.partition
+            selected = windows[bisect_right(windows, first):]
+            if end_ns is not None:
+                last = -(-end_ns // 1_000_000_000)
+                selected = selected[:bisect_left(selected, last)]
+            return [self._segment(measurement, drone_id, w) for w in selected]
+
+    def write(self, samples: list):
+        groups = defaultdict(list)
+        for sample in samples:
+            ns = _ns(sample.time)
+            window = ns // 1_000_000_000 // self.partition * self.partition
+            values = {**(sample.tags or {}), **sample.fields}
+            groups[(sample.measurement, sample.drone_id, window)].append(
+                (ns, values))
+
+        with self._write_lock:
+            for (measurement, drone_id, window), rows in groups.items():
+                with self._lock:
+                    segment = self._segment(measurement, drone_id, window)
+                segment.append(rows)
+                with self._lock:
+                    windows = self._index[(measurement, drone_id)]
+                    i = bisect_left(windows, window)
+                    if i == len(windows) or windows[i] != window:
+                        insort(windows, window)
+
+    @staticmethod
+    def _row(t: int, values: dict) -> dict:
+        return {**values, 'time': _datetime(t)}
+
+    def last(self, measurement: str, drone_id: str, start: datetime) -> dict:
+        start_ns = _ns(start)
+        for segment in reversed(self._windows(measurement, drone_id,
+                                              start_ns)):
+            rows = segment.read(start_ns, newest=True)
+            if rows:
+                return self._row(*rows[0])
+        return None
+
+    def last_per_drone(self, measurements: list, start: datetime) -> list:
+        with self._lock:
+            keys = [key for key in self._index if key[0] in measurements]
+        found = []
+        for measurement, drone_id in keys:
+            row = self.last(measurement, drone_id, start)
+            if row is not None:
+                found.append((drone_id, measurement, row))
+        return found
+
+    def positions(self, drone_id: str, start: datetime,
+                  after: datetime = None, window: int = None,
+                  desc: bool = False) -> list:
+        start_ns = _ns(start)
+        after_ns = _ns(after) if after is not None else None
+        rows = []
+        for segment in self._windows('position', drone_id, start_ns):
+            rows += segment.read(start_ns, after_ns)
+        # Segments are read in window order, only a backfilled point
+        # can land in an older one
+        rows.sort(key=lambda row: row[0])
+
+        if window and window > 1:
+            # Last point of every window, stamped with the window end
+            every = int(window) * 1_000_000_000
+            last = {}
+            for t, values in rows:
+                last[(t // every + 1) * every] = values
+            rows = list(last.items())
+
+        positions = [self._row(t, values) for t, values in rows]
+        if desc:
+            positions.reverse()
+        return positions
+
+    def positions_in_area(self, min_lat: float, max_lat: float,
+                          min_lon: float, max_lon: float,
+                          start: datetime) -> list:
+        start_ns = _ns(start)
+        with self._lock:
+            drones = [key[1] for key in self._index if key[0] == 'position']
+        positions = []
+        for drone_id in drones:
+            for segment in self._windows('position', drone_id, start_ns):
+                for t, values in segment.read(start_ns):
+                    if min_lat <= values['latitude'] <= max_lat \
+                            and min_lon <= values['longitude'] <= max_lon:
+                        positions.append({**self._row(t, values),
+                                          'drone_id': drone_id})
+        positions.sort(key=lambda row: row['time'], reverse=True)
+        return positions
+
+    def export(self, drone_id: str, measurements: list, start: datetime,
+               end: datetime):
+        streams = [self._export(measurement, drone_id, _ns(start), _ns(end))
+                   for measurement in measurements]
+        return heapq.merge(*streams, key=lambda item: item[1]['time'])
+
+    def _export(self, measurement: str, drone_id: str, start_ns: int,
+                end_ns: int):
+        # One segment in memory at a time
+        for segment in self._windows(measurement, drone_id, start_ns, end_ns):
+            for t, values in segment.read(start_ns):
+                if t >= end_ns:
+                    return
+                yield measurement, self._row(t, values)
+
+    def prune(self):
+        """Delete segments that fell out of the retention window."""
+        cutoff = int(time.time() - self.retention) - self.partition
+        expired = []
+        with self._lock:
+            for (measurement, drone_id), windows in list(self._index.items()):
+                count = bisect_right(windows, cutoff)
+                for window in windows[:count]:
+                    expired.append(os.path.join(
+                        self.path, measurement, _dirname(drone_id),
+                        str(window)))
+                    self._segments.pop((measurement, drone_id, window), None)
+                del windows[:count]
+                if not windows:
+                    del self._index[(measurement, drone_id)]
+        for path in expired:
+            shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,123 @@
+import csv
+import io
+import json
+from itertools import islice
+from cherum.embedded_storage import SCHEMA
+from cherum.storage import format_time
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+MEASUREMENTS = tuple(SCHEMA)
+# Rows per CSV/NDJSON chunk and per Parquet row group
+CHUNK_ROWS = 1000
+ROW_GROUP_ROWS = 10_000
+
+
+def columns(measurements: list) -> list:
+    """``(name, type code)`` of every field of ``measurements``, once."""
+    found = {}
+    for measurement in measurements:
+        found.update(SCHEMA[measurement])
+    return list(found.items())
+
+
+def _batches(rows, size: int):
+    rows = iter(rows)
+    while batch := list(islice(rows, size)):
+        yield batch
+
+
+def _cell(value):
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return value
+
+
+def to_csv(rows, measurements: list):
+    """``(measurement, row)`` pairs as CSV, one column per field."""
+    names = [name for name, _ in columns(measurements)]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["time", "measurement"] + names)
+    for batch in _batches(rows, CHUNK_ROWS):
+        for measurement, row in batch:
+            writer.writerow([format_time(row['time']), measurement]
+                            + [_cell(row.get(name)) for name in names])
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def to_ndjson(rows, measurements: list):
+    """``(measurement, row)`` pairs as one JSON object per line."""
+    names = [name for name, _ in columns(measurements)]
+    for batch in _batches(rows, CHUNK_ROWS):
+        lines = []
+        for measurement, row in batch:
+            record = {'time': format_time(row['time']),
+                      'measurement': measurement}
+            for name in names:
+                if row.get(name) is not None:
+                    record[name] = row[name]
+            lines.append(json.dumps(record) + "\n")
+        yield "".join(lines).encode()
+
+
+class _Chunks:
+    """Write-only file collecting what Parquet writes until taken."""
+
+    closed = False
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def to_parquet(rows, measurements: list):
+    """``(measurement, row)`` pairs as Parquet, a row group at a time."""
+    types = {'d': pyarrow.float64(), 'str': pyarrow.string(),
+             'b': pyarrow.bool_()}
+    fields = columns(measurements)
+    schema = pyarrow.schema(
+        [("time", pyarrow.timestamp("us", tz="UTC")),
+         ("measurement", pyarrow.string())]
+        + [(name, types[code]) for name, code in fields])
+    sink = _Chunks()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    try:
+        for batch in _batches(rows, ROW_GROUP_ROWS):
+            writer.write_table(pyarrow.Table.from_pylist([
+                {'time': row['time'], 'measurement': measurement,
+                 **{name: row.get(name) for name, _ in fields}}
+                for measurement, row in batch], schema=schema))
+            yield sink.take()
+    finally:
+        writer.close()
+    yield sink.take()
+
+
+# Writer and mimetype of every format, named by its file extension
+FORMATS = {
+    'csv': (to_csv, "text/csv"),
+    'ndjson': (to_ndjson, "application/x-ndjson"),
+    'parquet': (to_parquet, "application/vnd.apache.parquet"),
+}
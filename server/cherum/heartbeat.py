@@ -0,0 +1,184 @@
+import threading
+from contextlib import nullcontext
+from datetime import datetime, timedelta, timezone
+
+import click
+from flask import current_app
+
+import cherum.db as db
+from cherum.metrics import Histogram
+
+
+def _to_db(value: datetime) -> str:
+    return value.astimezone(timezone.utc).replace(tzinfo=None) \
+        .isoformat(" ", "seconds")
+
+
+def _from_db(value: datetime) -> datetime:
+    return value.replace(tzinfo=timezone.utc)
+
+
+class HeartbeatRegistry:
+    """In-memory last-seen time per drone, persisted as connection sessions.
+
+    Every ``beat`` only touches memory. Consecutive beats less than
+    ``timeout`` seconds apart belong to the same session; a longer gap
+    closes the session and opens a new one. Sessions are written to the
+    ``connections`` table when one opens and otherwise at most every
+    ``persist_interval`` seconds, and sessions older than ``retention``
+    days are deleted then too. Writes are timed into ``write_seconds``,
+    labelled ``connections``, when given.
+    """
+
+    def __init__(self, connect, timeout: float = 10,
+                 persist_interval: float = 30, retention: float = 30,
+                 write_seconds: Histogram = None):
+        self.connect = connect
+        self.timeout = timedelta(seconds=timeout)
+        self.persist_interval = timedelta(seconds=persist_interval)
+        self.retention = timedelta(days=retention)
+        self._lock = threading.Lock()
+        self._sessions = None
+        self._last_persist = None
+        self.write_seconds = write_seconds
+
+    def _load(self):
+        """Read the latest session of every drone on first use."""
+        if self._sessions is not None:
+            return
+        sessions = {}
+        rows = self.connect().execute(
+            "SELECT id, drone_id, connected_at, last_seen_at"
+            " FROM connections c WHERE id = ("
+            "  SELECT id FROM connections WHERE drone_id = c.drone_id"
+            "  ORDER BY last_seen_at DESC LIMIT 1)"
+        ).fetchall()
+        for row in rows:
+            sessions[row[1]] = {
+                'id': row[0],
+                'connected_at': _from_db(row[2]),
+                'last_seen': _from_db(row[3]),
+                'dirty': False
+            }
+        self._sessions = sessions
+        self._last_persist = datetime.now(timezone.utc)
+
+    def beat(self, drone_id: str = "default", now: datetime = None) -> bool:
+        """Record that ``drone_id`` was seen.
+
+        Returns ``True`` when this starts a new connection session.
+        """
+        now = now or datetime.now(timezone.utc)
+        with self._lock:
+            self._load()
+            session = self._sessions.get(drone_id)
+            connected = session is None \
+                or now - session['last_seen'] > self.timeout
+            if connected:
+                session = {
+                    'id': None,
+                    'connected_at': now,
+                    'last_seen': now,
+                    'dirty': True
+                }
+                self._sessions[drone_id] = session
+            else:
+                session['last_seen'] = now
+                session['dirty'] = True
+
+            if connected or now - self._last_persist >= self.persist_interval:
+                self._persist(now)
+        return connected
+
+    def last_seen(self, drone_id: str = None) -> datetime:
+        """Last beat of ``drone_id``, or of any drone when not given."""
+        with self._lock:
+            self._load()
+            if drone_id is not None:
+                session = self._sessions.get(drone_id)
+                return session['last_seen'] if session else None
+            return max((s['last_seen'] for s in self._sessions.values()),
+                       default=None)
+
+    def connected(self) -> int:
+        """How many drones beat within the last ``timeout``."""
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            if self._sessions is None:
+                return 0
+            return sum(1 for s in self._sessions.values()
+                       if now - s['last_seen'] <= self.timeout)
+
+    def _persist(self, now: datetime):
+        timer = nullcontext() if self.write_seconds is None \
+            else self.write_seconds.time(("connections",))
+        with timer:
+            self._write(now)
+
+    def _write(self, now: datetime):
+        conn = self.connect()
+        for drone_id, session in self._sessions.items():
+            if not session['dirty']:
+                continue
+            if session['id'] is None:
+                session['id'] = conn.execute(
+                    "INSERT INTO connections"
+                    " (drone_id, connected_at, last_seen_at) VALUES (?, ?, ?)",
+                    (drone_id, _to_db(session['connected_at']),
+                     _to_db(session['last_seen']))
+                ).lastrowid
+            else:
+                conn.execute(
+                    "UPDATE connections SET last_seen_at = ? WHERE id = ?",
+                    (_to_db(session['last_seen']), session['id'])
+                )
+            session['dirty'] = False
+        conn.execute(
+            "DELETE FROM connections WHERE last_seen_at < ?",
+            (_to_db(now - self.retention),)
+        )
+        conn.commit()
+        self._last_persist = now
+
+    def flush(self):
+        """Persist pending session updates right away."""
+        with self._lock:
+            if self._sessions is not None:
+                self._persist(datetime.now(timezone.utc))
+
+
+def compact_pings(conn, timeout: float = 10) -> int:
+    """Fold rows of the legacy ``pings`` table into connection sessions."""
+    db.migrate(conn)
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'pings'"
+    ).fetchone()
+    if exists is None:
+        return 0
+
+    gap = timedelta(seconds=timeout)
+    sessions = []
+    for (created_at,) in conn.execute(
+            "SELECT created_at FROM pings ORDER BY created_at"):
+        if sessions and created_at - sessions[-1][1] <= gap:
+            sessions[-1][1] = created_at
+        else:
+            sessions.append([created_at, created_at])
+
+    conn.executemany(
+        "INSERT INTO connections (drone_id, connected_at, last_seen_at)"
+        " VALUES ('default', ?, ?)",
+        [(_to_db(_from_db(start)), _to_db(_from_db(end)))
+         for start, end in sessions]
+    )
+    conn.execute("DROP TABLE pings")
+    conn.commit()
+    return len(sessions)
+
+
+@click.command('pings:compact')
+def compact_pings_command():
+    """Convert the legacy pings table into connection sessions."""
+    count = compact_pings(db.get(),
+                          float(current_app.config['HEARTBEAT_TIMEOUT']))
+    click.echo(f'Compacted pings into {count} connection sessions.')
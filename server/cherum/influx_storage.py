@@ -0,0 +1,180 @@
+import json
+from datetime import datetime
+from influxdb_client import InfluxDBClient, Point
+from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client.rest import ApiException
+from cherum.storage import StorageBackend, Sample, RejectedWrite, format_time
+import cherum.spatial as spatial
+
+
+def _since(value: datetime) -> str:
+    return f'time(v: "{format_time(value)}")'
+
+
+class InfluxStorage(StorageBackend):
+    """Telemetry kept in an InfluxDB 2 bucket, queried with Flux."""
+
+    def __init__(self, url: str = "http://localhost:8086",
+                 token: str = "your-token-here",
+                 org: str = "cherum",
+                 bucket: str = "drone_telemetry",
+                 pool_size: int = 9):
+        # Queries of one request overlap on the caller's thread pool and
+        # share the client's HTTP connection pool
+        self.client = InfluxDBClient(url=url, token=token, org=org,
+                                     connection_pool_maxsize=pool_size)
+        # Writes happen on the flusher thread, so they can block and retry
+        self.write_api = self.client.write_api(write_options=SYNCHRONOUS)
+        self.query_api = self.client.query_api()
+        self.bucket = bucket
+        self.org = org
+
+    @staticmethod
+    def _point(sample: Sample) -> Point:
+        point = Point(sample.measurement).tag("drone_id", sample.drone_id)
+        for key, value in (sample.tags or {}).items():
+            point = point.tag(key, value)
+        if sample.measurement == "position":
+            # Grid cells let area queries select series instead of scanning
+            lat = sample.fields['latitude']
+            lon = sample.fields['longitude']
+            point = point \
+                .tag("cell", spatial.cell_key(lat, lon, spatial.CELL_SIZE)) \
+                .tag("region", spatial.cell_key(lat, lon, spatial.REGION_SIZE))
+        for key, value in sample.fields.items():
+            point = point.field(key, value)
+        return point.time(sample.time)
+
+    def write(self, samples: list):
+        try:
+            self.write_api.write(bucket=self.bucket, org=self.org,
+                                 record=[self._point(s) for s in samples])
+        except ApiException as e:
+            # Malformed points, or points outside the bucket's retention
+            if e.status in (400, 422):
+                raise RejectedWrite(f"InfluxDB rejected the batch: {e.reason}") from e
+            raise
+
+    @staticmethod
+    def _row(record) -> dict:
+        row = {
+            key: value for key, value in record.values.items()
+            if not key.startswith("_") and key not in ("result", "table")
+        }
+        row['time'] = record.get_time()
+        return row
+
+    def _rows(self, query: str) -> list:
+        return [self._row(record)
+                for table in self.query_api.query(org=self.org, query=query)
+                for record in table.records]
+
+    def last(self, measurement: str, drone_id: str, start: datetime) -> dict:
+        query = f'''
+        from(bucket: "{self.bucket}")
+          |> range(start: {_since(start)})
+          |> filter(fn: (r) => r["_measurement"] == "{measurement}")
+          |> filter(fn: (r) => r["drone_id"] == "{drone_id}")
+          |> last()
+          |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")
+        '''
+        return max(self._rows(query), key=lambda row: row['time'],
+                   default=None)
+
+    def last_per_drone(self, measurements: list, start: datetime) -> list:
+        query = f'''
+        from(bucket: "{self.bucket}")
+          |> range(start: {_since(start)})
+          |> filter(fn: (r) => contains(value: r["_measurement"], set: {json.dumps(measurements)}))
+          |> last()
+          |> group(columns: ["drone_id", "_measurement", "_field"])
+          |> sort(columns: ["_time"])
+          |> last()
+        '''
+
+        rows = {}
+        for table in self.query_api.query(org=self.org, query=query):
+            for record in table.records:
+                key = (record.values.get('drone_id'), record.get_measurement())
+                row = rows.setdefault(key, {'time': record.get_time()})
+                row['time'] = max(row['time'], record.get_time())
+                row[record.get_field()] = record.get_value()
+        return [(drone_id, measurement, row)
+                for (drone_id, measurement), row in rows.items()]
+
+    def positions(self, drone_id: str, start: datetime,
+                  after: datetime = None, window: int = None,
+                  desc: bool = False) -> list:
+        newer = ""
+        if after is not None:
+            newer = f'''
+          |> filter(fn: (r) => r["_time"] > {_since(after)})'''
+        # Grid tags split a track into a table per cell, merge them back
+        # in time order before windowing
+        downsample = ""
+        if window and window > 1:
+            downsample = f'''
+          |> aggregateWindow(every: {int(window)}s, fn: last, createEmpty: false)'''
+
+        query = f'''
+        from(bucket: "{self.bucket}")
+          |> range(start: {_since(start)})
+          |> filter(fn: (r) => r["_measurement"] == "position")
+          |> filter(fn: (r) => r["drone_id"] == "{drone_id}"){newer}
+          |> drop(columns: ["cell", "region"])
+          |> sort(columns: ["_time"]){downsample}
+          |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")
+          |> sort(columns: ["_time"], desc: {"true" if desc else "false"})
+        '''
+        return self._rows(query)
+
+    def positions_in_area(self, min_lat: float, max_lat: float,
+                          min_lon: float, max_lon: float,
+                          start: datetime) -> list:
+        # Only select the grid cells (or coarser regions) overlapping the
+        # box, then filter exactly
+        cells = ""
+        for tag, size in (("cell", spatial.CELL_SIZE),
+                          ("region", spatial.REGION_SIZE)):
+            keys = spatial.covering_cells(min_lat, max_lat,
+                                          min_lon, max_lon, size)
+            if keys is not None:
+                cells = f'''
+          |> filter(fn: (r) => contains(value: r["{tag}"], set: {json.dumps(keys)}))'''
+                break
+
+        query = f'''
+        from(bucket: "{self.bucket}")
+          |> range(start: {_since(start)})
+          |> filter(fn: (r) => r["_measurement"] == "position"){cells}
+          |> filter(fn: (r) => r["_field"] == "latitude" or
+                              r["_field"] == "longitude" or
+                              r["_field"] == "altitude")
+          |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")
+          |> filter(fn: (r) => r.latitude >= {min_lat} and r.latitude <= {max_lat})
+          |> filter(fn: (r) => r.longitude >= {min_lon} and r.longitude <= {max_lon})
+          |> group()
+          |> sort(columns: ["_time"], desc: true)
+        '''
+        return self._rows(query)
+
+    def export(self, drone_id: str, measurements: list, start: datetime,
+               end: datetime):
+        query = f'''
+        from(bucket: "{self.bucket}")
+          |> range(start: {_since(start)}, stop: {_since(end)})
+          |> filter(fn: (r) => contains(value: r["_measurement"], set: {json.dumps(measurements)}))
+          |> filter(fn: (r) => r["drone_id"] == "{drone_id}")
+          |> drop(columns: ["cell", "region"])
+          |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")
+          |> group()
+          |> sort(columns: ["_time"])
+        '''
+        # Records are parsed off the response as it arrives
+        for record in self.query_api.query_stream(org=self.org, query=query):
+            row = self._row(record)
+            row.pop('drone_id', None)
+            yield record.get_measurement(), row
+
+    def close(self):
+        self.client.close()
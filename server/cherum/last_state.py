@@ -0,0 +1,68 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LastStateCache:
+    """Per-drone latest value of every telemetry measurement.
+
+    Entries are written by the ``TelemetryStore.store_*`` methods as points
+    arrive, so reads for the current state never have to go to InfluxDB.
+    Lookups that InfluxDB could not answer either are remembered for
+    ``miss_ttl`` seconds so an idle drone does not cost a query per poll,
+    and at most ``max_misses`` of them are kept.
+    """
+
+    def __init__(self, miss_ttl: float = 5, max_misses: int = 10_000):
+        self.miss_ttl = miss_ttl
+        self.max_misses = max_misses
+        self._lock = threading.Lock()
+        self._state = {}
+        # Oldest first, every miss lives for the same `miss_ttl`
+        self._misses = OrderedDict()
+
+    def lookup(self, drone_id: str, measurement: str):
+        """Return ``(found, value)`` for a drone measurement."""
+        with self._lock:
+            value = self._state.get(drone_id, {}).get(measurement)
+            if value is not None:
+                return True, value
+            self._expire(time.monotonic())
+            if (drone_id, measurement) in self._misses:
+                return True, None
+            return False, None
+
+    def put(self, drone_id: str, measurement: str, value) -> bool:
+        """Store ``value`` unless a newer one is already cached.
+
+        Returns whether ``value`` is now the latest state. A ``None`` value
+        records a miss instead of a state.
+        """
+        with self._lock:
+            if value is None:
+                now = time.monotonic()
+                self._misses[(drone_id, measurement)] = now + self.miss_ttl
+                self._misses.move_to_end((drone_id, measurement))
+                self._expire(now)
+                while len(self._misses) > self.max_misses:
+                    self._misses.popitem(last=False)
+                return False
+            self._misses.pop((drone_id, measurement), None)
+            drone = self._state.setdefault(drone_id, {})
+            current = drone.get(measurement)
+            if current is not None and current['time'] > value['time']:
+                return False
+            drone[measurement] = value
+            return True
+
+    def _expire(self, now: float):
+        while self._misses and next(iter(self._misses.values())) <= now:
+            self._misses.popitem(last=False)
+
+    def snapshot(self, drone_id: str) -> dict:
+        with self._lock:
+            return dict(self._state.get(drone_id, {}))
+
+    def drones(self) -> list:
+        with self._lock:
+            return list(self._state.keys())
@@ -0,0 +1,156 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Seconds, from a fast cache hit to a slow database round trip
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """A named family of values, one per combination of label values.
+
+    Counters and gauges can take their values from ``collect`` at scrape
+    time instead, so state the app already tracks costs nothing on the hot
+    path. ``collect`` returns a number, or a dict of label tuples to
+    numbers.
+    """
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple = (),
+                 collect=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.collect = collect
+        self._lock = threading.Lock()
+        # Scrapes see a zero before anything was counted
+        self._values = {} if self.labels else {(): 0}
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.help}",
+                f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> list:
+        if self.collect is not None:
+            values = self.collect()
+            values = list(values.items()) if isinstance(values, dict) \
+                else [((), values)]
+        else:
+            with self._lock:
+                values = list(self._values.items())
+        return self.header() + [
+            f"{self.name}{_labels(self.labels, key)} {value}"
+            for key, value in values]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, labels: tuple = ()):
+        with self._lock:
+            self._values[labels] = value
+
+    def dec(self, labels: tuple = (), amount: float = 1):
+        self.inc(labels, -amount)
+
+
+class Histogram(Metric):
+    """Observations counted into buckets, cumulated only when scraped."""
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (),
+                 buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value: float, labels: tuple = ()):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                # Bucket counts, +Inf last, then the sum
+                series = self._values[labels] = [0] * (len(self.buckets) + 2)
+            series[i] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, labels: tuple = ()):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, labels)
+
+    def render(self) -> list:
+        with self._lock:
+            values = [(key, list(series))
+                      for key, series in self._values.items()]
+        lines = self.header()
+        for key, series in values:
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                total += count
+                le = f'le="{bound}"'
+                lines.append(
+                    f"{self.name}_bucket{_labels(self.labels, key, le)} {total}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)}"
+                         f" {series[-1]}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)}"
+                         f" {total}")
+        return lines
+
+
+class Registry:
+    """Metrics of one app, rendered in the Prometheus text format."""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _add(self, metric: Metric) -> Metric:
+        existing = self._metrics.setdefault(metric.name, metric)
+        if type(existing) is not type(metric):
+            raise ValueError(f"Metric {metric.name} already registered")
+        return existing
+
+    def counter(self, name: str, help: str, labels: tuple = (),
+                collect=None) -> Counter:
+        return self._add(Counter(name, help, labels, collect))
+
+    def gauge(self, name: str, help: str, labels: tuple = (),
+              collect=None) -> Gauge:
+        return self._add(Gauge(name, help, labels, collect))
+
+    def histogram(self, name: str, help: str, labels: tuple = (),
+                  buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
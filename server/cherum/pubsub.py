@@ -0,0 +1,170 @@
+import asyncio
+import json
+import queue
+import threading
+
+
+def _wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _wake_threadsafe(waiter: tuple):
+    """Resolve a coroutine's ``(loop, future)`` from any thread."""
+    loop, future = waiter
+    try:
+        loop.call_soon_threadsafe(_wake, future)
+    except RuntimeError:
+        # Its loop is already closed
+        pass
+
+
+class Subscription:
+    """A single stream consumer, usually one open dashboard tab."""
+
+    def __init__(self, drone_id: str, max_pending: int):
+        self.drone_id = drone_id
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.lagging = False
+        self._waiter = None
+
+    def put(self, frame: bytes):
+        """Queue ``frame``, raising ``queue.Full`` when too far behind."""
+        self.queue.put_nowait(frame)
+        waiter = self._waiter
+        if waiter is not None:
+            _wake_threadsafe(waiter)
+
+    def get(self, timeout: float):
+        """Return the next encoded event, or ``None`` after ``timeout``."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    async def get_async(self, timeout: float):
+        """``get`` for coroutines, waiting without holding a thread."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._waiter = (loop, future)
+        try:
+            # Checked after setting the waiter so no put is missed
+            frame = self.get(timeout=0)
+            if frame is None:
+                try:
+                    await asyncio.wait_for(future, timeout)
+                except asyncio.TimeoutError:
+                    return None
+                frame = self.get(timeout=0)
+            return frame
+        finally:
+            self._waiter = None
+
+
+class TelemetryBroker:
+    """In-process fan-out of telemetry updates to stream subscribers.
+
+    Every event is encoded to its server-sent-events frame once in
+    ``publish`` and the same bytes are handed to all subscribers of that
+    drone. Subscribers that fall ``max_pending`` events behind are marked as
+    lagging and dropped; the browser reconnects and resyncs on its own.
+    """
+
+    def __init__(self, dumps=json.dumps, max_pending: int = 256):
+        self.dumps = dumps
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def subscribe(self, drone_id: str) -> Subscription:
+        sub = Subscription(drone_id, self.max_pending)
+        with self._lock:
+            self._subscribers.setdefault(drone_id, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        with self._lock:
+            subs = self._subscribers.get(sub.drone_id)
+            if subs is None:
+                return
+            subs.discard(sub)
+            if not subs:
+                del self._subscribers[sub.drone_id]
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return sum(len(subs) for subs in self._subscribers.values())
+
+    def publish(self, drone_id: str, event: str, data):
+        """Encode ``data`` once and queue it for the drone's subscribers."""
+        with self._lock:
+            subs = list(self._subscribers.get(drone_id, ()))
+        self._deliver(subs, event, data)
+
+    def broadcast(self, event: str, data):
+        """Encode ``data`` once and queue it for every subscriber."""
+        with self._lock:
+            subs = [sub for subs in self._subscribers.values()
+                    for sub in subs]
+        self._deliver(subs, event, data)
+
+    def _deliver(self, subs: list, event: str, data):
+        if not subs:
+            return
+
+        frame = f"event: {event}\ndata: {self.dumps(data)}\n\n".encode()
+        for sub in subs:
+            try:
+                sub.put(frame)
+            except queue.Full:
+                sub.lagging = True
+                self.unsubscribe(sub)
+
+
+class Notifier:
+    """Wakes threads and coroutines parked on an event, such as a new command.
+
+    Waiters read ``version`` before checking their condition and pass it to
+    ``wait`` so a notification that lands in between is not lost.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._version = 0
+        self._waiters = set()
+
+    @property
+    def version(self) -> int:
+        with self._cond:
+            return self._version
+
+    def notify(self):
+        with self._cond:
+            self._version += 1
+            self._cond.notify_all()
+            waiters, self._waiters = self._waiters, set()
+        for waiter in waiters:
+            _wake_threadsafe(waiter)
+
+    def wait(self, version: int, timeout: float) -> bool:
+        """Block until notified after ``version`` or ``timeout`` passes."""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: self._version != version, timeout)
+
+    async def wait_async(self, version: int, timeout: float) -> bool:
+        """``wait`` for coroutines, without holding a thread."""
+        loop = asyncio.get_running_loop()
+        waiter = (loop, loop.create_future())
+        with self._cond:
+            if self._version != version:
+                return True
+            self._waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1], timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cond:
+                self._waiters.discard(waiter)
+        return self.version != version
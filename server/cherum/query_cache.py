@@ -0,0 +1,97 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class _Entry:
+    __slots__ = ('value', 'version', 'loaded')
+
+    def __init__(self, value, version: int, loaded: float):
+        self.value = value
+        self.version = version
+        self.loaded = loaded
+
+
+class QueryCache:
+    """Backend read results shared by every request asking the same thing.
+
+    Entries are keyed by query and belong to a drone, or to the whole fleet
+    when ``drone_id`` is ``None``. ``touch`` marks a drone's entries, and
+    the fleet's, out of date once new points of it are stored. An out of
+    date entry is brought up to date with ``extend`` when the caller has
+    one, instead of being read again from scratch. Entries are reloaded
+    after ``ttl`` seconds regardless, and at most ``max_entries`` are kept.
+
+    Concurrent reads of the same key share one backend query: the first
+    caller runs it, the others wait for its result. Cached values are
+    shared, callers must not modify them.
+    """
+
+    def __init__(self, ttl: float = 60, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, drone_id, load, extend=None):
+        """Cached value of ``key``, computed by ``load()`` when missing.
+
+        ``extend(value)`` returns an out of date ``value`` updated with
+        what was stored since.
+        """
+        with self._lock:
+            version = self._versions.get(drone_id, 0)
+            entry = self._entries.get(key)
+            fresh = entry is not None \
+                and time.monotonic() - entry.loaded < self.ttl
+            if fresh and entry.version == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry.value
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = self._pending[key] = Future()
+                leader = True
+                self.misses += 1
+            else:
+                leader = False
+                self.hits += 1
+        if not leader:
+            return pending.result()
+
+        try:
+            if fresh and extend is not None:
+                value = extend(entry.value)
+                loaded = entry.loaded
+            else:
+                loaded = time.monotonic()
+                value = load()
+        except BaseException as e:
+            with self._lock:
+                del self._pending[key]
+            pending.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._pending[key]
+            # Points stored while loading leave the entry out of date
+            self._entries[key] = _Entry(value, version, loaded)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        pending.set_result(value)
+        return value
+
+    def touch(self, drone_ids):
+        """Mark cached reads of ``drone_ids`` and of the fleet out of date."""
+        with self._lock:
+            for drone_id in set(drone_ids) | {None}:
+                self._versions[drone_id] = self._versions.get(drone_id, 0) + 1
+
+    def __len__(self) -> int:
+        return len(self._entries)
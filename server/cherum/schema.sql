@@ -1,5 +1,6 @@
 DROP TABLE IF EXISTS commands;
 DROP TABLE IF EXISTS pings;
+DROP TABLE IF EXISTS connections;
 
 CREATE TABLE commands (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -8,7 +9,15 @@ CREATE TABLE commands (
   created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
 );
 
-CREATE TABLE pings(
+CREATE INDEX commands_created_at ON commands (created_at);
+
+CREATE TABLE connections (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
-  created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+  drone_id TEXT NOT NULL,
+  connected_at TIMESTAMP NOT NULL,
+  last_seen_at TIMESTAMP NOT NULL
 );
+
+CREATE INDEX connections_drone_last_seen
+  ON connections (drone_id, last_seen_at);
+CREATE INDEX connections_last_seen ON connections (last_seen_at);
@@ -0,0 +1,58 @@
+import heapq
+
+
+def _area(a, b, c) -> float:
+    """Twice the area of the triangle between three (x, y) points."""
+    return abs((b[0] - a[0]) * (c[1] - a[1]) - (c[0] - a[0]) * (b[1] - a[1]))
+
+
+def simplify_track(points: list, max_points: int,
+                   x: str = 'longitude', y: str = 'latitude') -> list:
+    """Reduce a track to ``max_points`` keeping its shape (Visvalingam-Whyatt).
+
+    Repeatedly drops the point whose triangle with its neighbours has the
+    smallest area, so straight runs collapse first and turns are kept. The
+    first and last points are always kept and order is preserved.
+    """
+    if len(points) <= max_points:
+        return points
+    coords = [(p[x] or 0.0, p[y] or 0.0) for p in points]
+    return [points[i] for i in simplify_indices(coords, max_points)]
+
+
+def simplify_indices(coords: list, max_points: int) -> list:
+    """Indices of the ``(x, y)`` coords kept by ``simplify_track``."""
+    n = len(coords)
+    if n <= max_points:
+        return list(range(n))
+    if max_points < 2:
+        return list(range(max(max_points, 0)))
+
+    prev = list(range(-1, n - 1))
+    nxt = list(range(1, n + 1))
+    removed = [False] * n
+    areas = [float('inf')] * n
+    heap = []
+    for i in range(1, n - 1):
+        areas[i] = _area(coords[i - 1], coords[i], coords[i + 1])
+        heap.append((areas[i], i))
+    heapq.heapify(heap)
+
+    remaining = n
+    while remaining > max_points:
+        area, i = heapq.heappop(heap)
+        if removed[i] or area != areas[i]:
+            continue
+        removed[i] = True
+        remaining -= 1
+        p, q = prev[i], nxt[i]
+        nxt[p], prev[q] = q, p
+        # A neighbour's area never drops below the one just removed, so
+        # points are eliminated in a consistent order
+        for j in (p, q):
+            if 0 < j < n - 1:
+                areas[j] = max(area, _area(coords[prev[j]], coords[j],
+                                           coords[nxt[j]]))
+                heapq.heappush(heap, (areas[j], j))
+
+    return [i for i in range(n) if not removed[i]]
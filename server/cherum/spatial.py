@@ -0,0 +1,112 @@
+import math
+import threading
+import time
+from collections import deque
+
+# Grid cells stored as tags on every position, finest first
+CELL_SIZE = 0.05  # degrees, about 5.5 km of latitude
+REGION_SIZE = 1.0
+
+
+def cell_key(lat: float, lon: float, size: float = CELL_SIZE) -> str:
+    return f"{math.floor(lat / size)}:{math.floor(lon / size)}"
+
+
+def covering_cells(min_lat: float, max_lat: float, min_lon: float,
+                   max_lon: float, size: float = CELL_SIZE,
+                   limit: int = 64) -> list:
+    """Keys of the grid cells overlapping a bounding box.
+
+    Returns ``None`` when more than ``limit`` cells would be needed.
+    """
+    rows = range(math.floor(min_lat / size), math.floor(max_lat / size) + 1)
+    cols = range(math.floor(min_lon / size), math.floor(max_lon / size) + 1)
+    if len(rows) * len(cols) > limit:
+        return None
+    return [f"{row}:{col}" for row in rows for col in cols]
+
+
+class RecentGrid:
+    """In-memory grid of the positions seen in the last ``retention`` seconds.
+
+    A bounding-box lookup only visits the cells overlapping the box, so its
+    cost follows the number of nearby points rather than total history.
+    Each cell holds at most ``max_per_cell`` points, oldest dropped first;
+    the grid stops covering a window that lost points that way.
+    """
+
+    def __init__(self, retention: float = 3600, max_per_cell: int = 10_000,
+                 size: float = CELL_SIZE):
+        self.retention = retention
+        self.max_per_cell = max_per_cell
+        self.size = size
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._cells = {}
+        # Newest point dropped from each full cell
+        self._truncated = {}
+
+    def covers(self, seconds: float) -> bool:
+        """Whether the grid holds every point of the last ``seconds``."""
+        now = time.time()
+        if seconds > self.retention or now - self.started < seconds:
+            return False
+        with self._lock:
+            return all(dropped < now - seconds
+                       for dropped in self._truncated.values())
+
+    def insert(self, drone_id: str, when, lat: float, lon: float,
+               alt: float):
+        key = cell_key(lat, lon, self.size)
+        cutoff = time.time() - self.retention
+        with self._lock:
+            cell = self._cells.get(key)
+            if cell is None:
+                cell = self._cells[key] = deque(maxlen=self.max_per_cell)
+            if len(cell) == cell.maxlen:
+                self._truncated[key] = max(self._truncated.get(key, 0),
+                                           cell[0][0])
+            cell.append((when.timestamp(), drone_id, when, lat, lon, alt))
+            while cell and cell[0][0] < cutoff:
+                cell.popleft()
+
+    def query(self, min_lat: float, max_lat: float, min_lon: float,
+              max_lon: float, seconds: float) -> list:
+        """Positions inside the box newer than ``seconds`` ago, newest first."""
+        cutoff = time.time() - seconds
+        keys = covering_cells(min_lat, max_lat, min_lon, max_lon, self.size,
+                              limit=len(self._cells) or 1)
+        with self._lock:
+            if keys is None:
+                # A box larger than the populated area: scan what is there
+                cells = list(self._cells.values())
+            else:
+                cells = [self._cells[k] for k in keys if k in self._cells]
+            matches = [
+                point for cell in cells for point in cell
+                if point[0] >= cutoff
+                and min_lat <= point[3] <= max_lat
+                and min_lon <= point[4] <= max_lon
+            ]
+
+        matches.sort(key=lambda point: point[0], reverse=True)
+        return [{
+            'time': point[2],
+            'drone_id': point[1],
+            'latitude': point[3],
+            'longitude': point[4],
+            'altitude': point[5]
+        } for point in matches]
+
+    def prune(self):
+        """Drop expired points and empty cells."""
+        cutoff = time.time() - self.retention
+        with self._lock:
+            for key, cell in list(self._cells.items()):
+                while cell and cell[0][0] < cutoff:
+                    cell.popleft()
+                if not cell:
+                    del self._cells[key]
+            for key, dropped in list(self._truncated.items()):
+                if dropped < cutoff:
+                    del self._truncated[key]
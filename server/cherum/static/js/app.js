@@ -6,11 +6,33 @@ const FLIGHT_MODE_TO_COMMAND = {
   "LAND": "land"
 }
 
+const TRACK_MIMETYPE = "application/vnd.cherum.track+json";
+
+// Decode the compact track encoding: delta coded fixed point columns
+function decodeTrack(track) {
+  const points = [];
+  let time = 0, latitude = 0, longitude = 0, altitude = 0;
+  for (let i = 0; i < track.count; i++) {
+    time += track.time[i];
+    latitude += track.latitude[i];
+    longitude += track.longitude[i];
+    altitude += track.altitude[i];
+    points.push({
+      time: new Date(time * 1000 / track.scale.time),
+      latitude: latitude / track.scale.latlon,
+      longitude: longitude / track.scale.latlon,
+      altitude: altitude / track.scale.altitude
+    });
+  }
+  return points;
+}
+
 class DroneControl {
   constructor() {
     this.connectionStatus = {
       connected: false,
       lastConnection: 'Never',
+      lastSeen: null,
       checkInterval: null
     };
 
@@ -25,6 +47,11 @@ class DroneControl {
     this.loading = { telemetry: true, connection: true };
     this.error = null;
 
+    // Server push stream, polling is only used while it is down
+    this.stream = null;
+    this.connectionInterval = null;
+    this.telemetryInterval = null;
+
     // Map related properties
     this.map = null;
     this.droneMarker = null;
@@ -55,6 +82,7 @@ class DroneControl {
 
     // Initialize map
     this.initMap();
+    this.loadTrajectory();
 
     this.initListeners();
 
@@ -62,9 +90,57 @@ class DroneControl {
     this.updateConnectionStatus();
     this.updateTelemetry();
 
-    // Set up intervals
-    this.connectionInterval = setInterval(() => this.updateConnectionStatus(), 1000);
-    this.telemetryInterval = setInterval(() => this.updateTelemetry(), 500);
+    // Connection age is re-evaluated locally, updates come from the stream
+    this.connectionStatus.checkInterval = setInterval(() => this.refreshConnectionStatus(), 1000);
+
+    if (window.EventSource) {
+      this.initStream();
+    } else {
+      this.startPolling();
+    }
+  }
+
+  initStream() {
+    this.stream = new EventSource('/stream/telemetry');
+
+    this.stream.addEventListener('open', () => {
+      this.stopPolling();
+      // Resync anything published while the stream was down
+      this.updateConnectionStatus();
+      this.updateTelemetry();
+    });
+
+    this.stream.addEventListener('error', () => {
+      this.startPolling();
+    });
+
+    this.stream.addEventListener('telemetry', (e) => {
+      this.applyTelemetry(JSON.parse(e.data));
+    });
+
+    this.stream.addEventListener('connection', (e) => {
+      this.applyConnection(JSON.parse(e.data));
+    });
+  }
+
+  startPolling() {
+    if (!this.connectionInterval) {
+      this.connectionInterval = setInterval(() => this.updateConnectionStatus(), 1000);
+    }
+    if (!this.telemetryInterval) {
+      this.telemetryInterval = setInterval(() => this.updateTelemetry(), 500);
+    }
+  }
+
+  stopPolling() {
+    if (this.connectionInterval) {
+      clearInterval(this.connectionInterval);
+      this.connectionInterval = null;
+    }
+    if (this.telemetryInterval) {
+      clearInterval(this.telemetryInterval);
+      this.telemetryInterval = null;
+    }
   }
 
   initListeners() {
@@ -91,19 +167,7 @@ class DroneControl {
     try {
       const response = await fetch('/last/connection');
       const text = await response.text();
-
-      if (text && text !== 'Never') {
-        const date = new Date(text.replace(' ', 'T'));
-        const now = new Date();
-        this.connectionStatus.connected = (now - date) < 10000;
-        this.connectionStatus.lastConnection = this.formatDateTime(date);
-      } else {
-        this.connectionStatus.connected = false;
-        this.connectionStatus.lastConnection = 'Never';
-      }
-
-      this.updateConnectionUI();
-      this.loading.connection = false;
+      this.applyConnection(text);
     } catch (error) {
       console.error('Error fetching connection status:', error);
       this.connectionStatus.connected = false;
@@ -111,47 +175,72 @@ class DroneControl {
     }
   }
 
+  applyConnection(text) {
+    if (text && text !== 'Never') {
+      const date = new Date(text.replace(' ', 'T'));
+      this.connectionStatus.lastSeen = date;
+      this.connectionStatus.lastConnection = this.formatDateTime(date);
+    } else {
+      this.connectionStatus.lastSeen = null;
+      this.connectionStatus.lastConnection = 'Never';
+    }
+
+    this.refreshConnectionStatus();
+    this.loading.connection = false;
+  }
+
+  refreshConnectionStatus() {
+    const lastSeen = this.connectionStatus.lastSeen;
+    this.connectionStatus.connected = lastSeen !== null && (new Date() - lastSeen) < 10000;
+    this.updateConnectionUI();
+  }
+
   async updateTelemetry() {
     try {
       const response = await fetch('/last/telemetry');
       const data = await response.json();
+      this.applyTelemetry(data);
+    } catch (error) {
+      console.error('Error fetching telemetry:', error);
+      this.showError('Error al obtener telemetría');
+    }
+  }
 
-      // Update telemetry data
-      if (data.position) {
-        this.telemetry.position = {
-          latitude: parseFloat(data.position.latitude),
-          longitude: parseFloat(data.position.longitude),
-          altitude: parseFloat(data.position.altitude)
-        };
-      }
+  applyTelemetry(data) {
+    // Update telemetry data, both full snapshots and stream deltas
+    if (data.position) {
+      this.telemetry.position = {
+        latitude: parseFloat(data.position.latitude),
+        longitude: parseFloat(data.position.longitude),
+        altitude: parseFloat(data.position.altitude)
+      };
+    }
 
-      if (data.battery) {
-        this.telemetry.battery = {
-          percentage: data.battery.percentage,
-          id: data.battery.id
-        };
-      }
+    if (data.battery) {
+      this.telemetry.battery = {
+        percentage: data.battery.percentage,
+        id: data.battery.id
+      };
+    }
 
-      if (data.flight_mode) {
-        this.telemetry.flightMode = data.flight_mode.mode;
-      }
+    if (data.flight_mode) {
+      this.telemetry.flightMode = data.flight_mode.mode;
+    }
 
-      if (data.armed) {
-        this.telemetry.armed = data.armed.armed;
-      }
+    if (data.armed) {
+      this.telemetry.armed = data.armed.armed;
+    }
 
-      if (data.in_air) {
-        this.telemetry.inAir = data.in_air.in_air;
-      }
+    if (data.in_air) {
+      this.telemetry.inAir = data.in_air.in_air;
+    }
 
-      this.updateTelemetryUI();
+    this.updateTelemetryUI();
+    if (data.position) {
       this.updateMapPosition();
-      this.loading.telemetry = false;
-      this.clearError();
-    } catch (error) {
-      console.error('Error fetching telemetry:', error);
-      this.showError('Error al obtener telemetría');
     }
+    this.loading.telemetry = false;
+    this.clearError();
   }
 
   updateConnectionUI() {
@@ -328,6 +417,27 @@ class DroneControl {
     }
   }
 
+  async loadTrajectory(minutes = 10) {
+    try {
+      const response = await fetch(
+        `/telemetry?minutes=${minutes}&max_points=${this.maxTrajectoryPoints}`,
+        { headers: { Accept: TRACK_MIMETYPE } }
+      );
+      if (!response.ok) {
+        return;
+      }
+      const points = decodeTrack(await response.json());
+      // Keep anything the live updates added while this was loading
+      this.trajectoryPoints = points
+        .map((p) => [p.latitude, p.longitude])
+        .concat(this.trajectoryPoints)
+        .slice(-this.maxTrajectoryPoints);
+      this.trajectory.setLatLngs(this.trajectoryPoints);
+    } catch (error) {
+      console.error('Error fetching trajectory:', error);
+    }
+  }
+
   clearTrajectory() {
     this.trajectoryPoints = [];
     this.trajectory.setLatLngs([]);
@@ -341,11 +451,12 @@ class DroneControl {
   }
 
   destroy() {
-    if (this.connectionInterval) {
-      clearInterval(this.connectionInterval);
+    if (this.stream) {
+      this.stream.close();
     }
-    if (this.telemetryInterval) {
-      clearInterval(this.telemetryInterval);
+    this.stopPolling();
+    if (this.connectionStatus.checkInterval) {
+      clearInterval(this.connectionStatus.checkInterval);
     }
     if (this.map) {
       this.map.remove();
@@ -0,0 +1,105 @@
+from datetime import datetime, timezone
+from typing import NamedTuple
+
+
+def parse_time(value) -> datetime:
+    """Timestamps are epoch seconds or ISO 8601 strings, naive means UTC."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            pass
+    if isinstance(value, (int, float)):
+        try:
+            return datetime.fromtimestamp(value, timezone.utc)
+        except (OverflowError, OSError):
+            raise ValueError(f"Timestamp out of range: {value}") from None
+    if not isinstance(value, str):
+        raise ValueError(f"Invalid timestamp: {value!r}")
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    time = datetime.fromisoformat(value)
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=timezone.utc)
+    return time
+
+
+def format_time(value: datetime) -> str:
+    """RFC 3339 in UTC, safe to pass unencoded in a query string."""
+    return value.astimezone(timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+class RejectedWrite(Exception):
+    """The backend refused a batch for good, writing it again cannot help."""
+
+
+class Sample(NamedTuple):
+    """One telemetry point on its way to a storage backend."""
+    measurement: str
+    drone_id: str
+    time: datetime
+    fields: dict
+    tags: dict = None
+
+
+class StorageBackend:
+    """Where ``TelemetryStore`` keeps telemetry points.
+
+    Rows handed back are dicts with a ``time`` (an aware UTC datetime) and
+    the stored field names as keys. Implementations must be safe to call
+    from several threads: writes come from the flusher thread, reads from
+    the query pool and request threads.
+    """
+
+    def write(self, samples: list):
+        """Persist a batch of ``Sample``, raising if nothing was written.
+
+        Raises ``RejectedWrite`` when the same batch would never be
+        accepted, anything else is worth retrying.
+        """
+        raise NotImplementedError
+
+    def last(self, measurement: str, drone_id: str, start: datetime) -> dict:
+        """Newest row of a drone measurement since ``start``, or ``None``."""
+        raise NotImplementedError
+
+    def last_per_drone(self, measurements: list, start: datetime) -> list:
+        """``(drone_id, measurement, row)`` with the newest row of each."""
+        raise NotImplementedError
+
+    def positions(self, drone_id: str, start: datetime,
+                  after: datetime = None, window: int = None,
+                  desc: bool = False) -> list:
+        """Position rows of a drone since ``start``, sorted by time.
+
+        With ``after`` only rows strictly newer than it are returned. With
+        ``window`` only the last row of every ``window`` seconds is kept,
+        stamped with the end of its window.
+        """
+        raise NotImplementedError
+
+    def positions_in_area(self, min_lat: float, max_lat: float,
+                          min_lon: float, max_lon: float,
+                          start: datetime) -> list:
+        """Position rows of every drone inside a box, newest first.
+
+        Rows carry a ``drone_id`` key.
+        """
+        raise NotImplementedError
+
+    def export(self, drone_id: str, measurements: list, start: datetime,
+               end: datetime):
+        """Iterate ``(measurement, row)`` from ``start`` up to ``end``.
+
+        Rows of all ``measurements`` come merged oldest first, read lazily
+        so a long range is never held in memory at once.
+        """
+        raise NotImplementedError
+
+    def prune(self):
+        """Periodic housekeeping, called from the flusher thread."""
+
+    def close(self):
+        """Release connections and files."""
@@ -1,253 +1,680 @@
-from datetime import datetime
-from influxdb_client import InfluxDBClient, Point
-from influxdb_client.client.write_api import ASYNCHRONOUS
+import asyncio
+import logging
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from cherum.last_state import LastStateCache
+from cherum.metrics import Registry
+from cherum.pubsub import TelemetryBroker
+from cherum.query_cache import QueryCache
+from cherum.simplify import simplify_track, simplify_indices
+from cherum.storage import StorageBackend, Sample, RejectedWrite, \
+    parse_time, format_time
+from cherum.influx_storage import InfluxStorage
+from cherum.track import encode_track
+from cherum.spatial import RecentGrid
+
+logger = logging.getLogger(__name__)
+
+# Longest wait between retries while the backend keeps failing writes
+MAX_FLUSH_BACKOFF = 300
+
+
+# Stored field to response key of every measurement
+FLEET_FIELDS = {
+    'position': {
+        'latitude': 'latitude',
+        'longitude': 'longitude',
+        'altitude': 'altitude'
+    },
+    'battery': {'remaining_percent': 'percentage'},
+    'flight_mode': {'mode': 'mode'},
+    'armed': {'armed': 'armed'},
+    'in_air': {'in_air': 'in_air'}
+}
+
+
+def _time(row: dict) -> datetime:
+    return row['time']
+
+
+def _flag(value) -> bool:
+    """A boolean field, also sent as 0 or 1 by some clients."""
+    if isinstance(value, bool) or value in (0, 1):
+        return bool(value)
+    raise ValueError(f"Expected a boolean: {value!r}")
+
+
+def _trim(rows: list, start: datetime, window: int) -> list:
+    """Rows still inside a time range starting at ``start``.
+
+    Downsampled rows are stamped with the end of their window, and a window
+    is in range as long as it ends after ``start``.
+    """
+    find = bisect_right if window else bisect_left
+    return rows[find(rows, start, key=_time):]
 
 
 class TelemetryStore:
-    """Efficient storage for drone telemetry using InfluxDB."""
+    """Efficient storage for drone telemetry.
+
+    Points are kept by a ``StorageBackend``, InfluxDB unless another one
+    is given.
+    """
 
     def __init__(self, url: str = "http://localhost:8086",
                  token: str = "your-token-here",
                  org: str = "cherum",
-                 bucket: str = "drone_telemetry"):
-        self.client = InfluxDBClient(url=url, token=token, org=org)
-        self.write_api = self.client.write_api(write_options=ASYNCHRONOUS)
-        self.query_api = self.client.query_api()
-        self.bucket = bucket
-        self.org = org
-
-        # Buffer for batch writes (more efficient)
-        self.buffer = []
-        self.buffer_size = 100  # Write every 100 points
-        self.last_flush = datetime.now()
-        self.flush_interval = 5  # Flush every 5 seconds
+                 bucket: str = "drone_telemetry",
+                 broker: TelemetryBroker = None,
+                 buffer_size: int = 100,
+                 flush_interval: float = 5,
+                 max_buffer: int = 100_000,
+                 query_workers: int = 8,
+                 query_timeout: float = 2,
+                 recent_area_seconds: float = 3600,
+                 cache_ttl: float = 60,
+                 export_window: float = 3600,
+                 backend: StorageBackend = None,
+                 metrics: Registry = None):
+        self.backend = backend or InfluxStorage(
+            url=url, token=token, org=org, bucket=bucket,
+            pool_size=query_workers + 1)
+        # Reads run on a bounded thread pool, so the queries of one
+        # request overlap
+        self.query_executor = ThreadPoolExecutor(
+            max_workers=query_workers, thread_name_prefix="telemetry-query")
+        self.query_timeout = query_timeout
+        # Downsampling leaves this many times `max_points` for the
+        # shape-preserving simplification to choose from
+        self.track_oversample = 4
+        # Exports read this many seconds per backend query
+        self.export_window = export_window
+        # Reads shared between dashboards looking at the same thing
+        self.cache = QueryCache(ttl=cache_ttl)
+        # Recent positions by grid cell for bounding-box lookups
+        self.recent_grid = RecentGrid(retention=recent_area_seconds)
+
+        # Buffer for batch writes, drained by a background flusher thread
+        # every `flush_interval` seconds or once `buffer_size` points queue
+        # up. At most `max_buffer` points are held while the backend is
+        # unreachable; older ones are dropped and counted. After a failed
+        # flush the next one waits `flush_interval`, doubling on every
+        # further failure, however full the buffer gets.
+        self.buffer = deque(maxlen=max_buffer)
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.last_flush = time.monotonic()
+        self.last_flush_size = 0
+        self.dropped_points = 0
+        self.flush_failures = 0
+        self.rejected_points = 0
+        self._backoff = 0
+        self._retry_at = 0
+        self._buffer_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closing = False
+        self._flusher = threading.Thread(target=self._run_flusher,
+                                         name="telemetry-flusher",
+                                         daemon=True)
+        self._flusher.start()
+
+        # Latest value per drone and measurement, fed by the store_* methods
+        self.last_state = LastStateCache()
+        self._fleet_loaded = False
+        # Pushes every stored value to the telemetry stream subscribers
+        self.broker = broker or TelemetryBroker()
+
+        metrics = metrics or Registry()
+        self.points_received = metrics.counter(
+            "cherum_telemetry_points_total",
+            "Telemetry points accepted.", ("measurement", "drone_id"))
+        metrics.gauge("cherum_telemetry_buffer_points",
+                      "Points waiting to be flushed.",
+                      collect=lambda: len(self.buffer))
+        metrics.counter("cherum_telemetry_dropped_points_total",
+                        "Points dropped because the buffer was full.",
+                        collect=lambda: self.dropped_points)
+        metrics.counter("cherum_telemetry_flush_failures_total",
+                        "Flushes the backend rejected.",
+                        collect=lambda: self.flush_failures)
+        metrics.counter("cherum_telemetry_rejected_points_total",
+                        "Points dropped because the backend refused them.",
+                        collect=lambda: self.rejected_points)
+        self.flush_points = metrics.histogram(
+            "cherum_telemetry_flush_points", "Points written per flush.",
+            buckets=(1, 10, 50, 100, 250, 500, 1000, 5000, 10_000, 100_000))
+        self.flush_seconds = metrics.histogram(
+            "cherum_telemetry_flush_seconds", "Time spent writing a flush.")
+        self.query_seconds = metrics.histogram(
+            "cherum_storage_query_seconds",
+            "Time the storage backend took to answer a read.", ("query",))
+        self.query_timeouts = metrics.counter(
+            "cherum_storage_query_timeouts_total",
+            "Reads abandoned after query_timeout.", ("query",))
+        metrics.counter("cherum_query_cache_hits_total",
+                        "Reads answered by the cache or a read in flight.",
+                        collect=lambda: self.cache.hits)
+        metrics.counter("cherum_query_cache_misses_total",
+                        "Reads that went to the backend.",
+                        collect=lambda: self.cache.misses)
 
     async def last_position(self, drone_id: str = "default"):
-        query = f'''
-        from(bucket: "{self.bucket}")
-          |> range(start: -24h)
-          |> filter(fn: (r) => r["_measurement"] == "position")
-          |> filter(fn: (r) => r["drone_id"] == "{drone_id}")
-          |> last()
-          |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")
-        '''
-
-        result = self.query_api.query(org=self.org, query=query)
-        for table in result:
-            for record in table.records:
-                return {
-                    'time': record.get_time(),
-                    'latitude': record.values.get('latitude'),
-                    'longitude': record.values.get('longitude'),
-                    'altitude': record.values.get('altitude')
-                }
-        return None
+        return await self._last(drone_id, "position")
 
     async def last_battery(self, drone_id: str = "default"):
-        query = f'''
-        from(bucket: "{self.bucket}")
-          |> range(start: -24h)
-          |> filter(fn: (r) => r["_measurement"] == "battery")
-          |> filter(fn: (r) => r["drone_id"] == "{drone_id}")
-          |> last()
-        '''
-
-        result = self.query_api.query(org=self.org, query=query)
-        for table in result:
-            for record in table.records:
-                return {
-                    'time': record.get_time(),
-                    'percentage': record.get_value()
-                }
-
-        return None
+        return await self._last(drone_id, "battery")
 
     async def last_flight_mode(self, drone_id: str = "default"):
-        query = f'''
-        from(bucket: "{self.bucket}")
-          |> range(start: -24h)
-          |> filter(fn: (r) => r["_measurement"] == "flight_mode")
-          |> filter(fn: (r) => r["drone_id"] == "{drone_id}")
-          |> last()
-        '''
-
-        result = self.query_api.query(org=self.org, query=query)
-        for table in result:
-            for record in table.records:
-                return {
-                    'time': record.get_time(),
-                    'mode': record.get_value()
-                }
-        return None
+        return await self._last(drone_id, "flight_mode")
 
     async def last_armed(self, drone_id: str = "default"):
-        query = f'''
-        from(bucket: "{self.bucket}")
-          |> range(start: -24h)
-          |> filter(fn: (r) => r["_measurement"] == "armed")
-          |> filter(fn: (r) => r["drone_id"] == "{drone_id}")
-          |> last()
-        '''
-
-        result = self.query_api.query(org=self.org, query=query)
-        for table in result:
-            for record in table.records:
-                return {
-                    'time': record.get_time(),
-                    'armed': record.get_value()
-                }
-        return None
+        return await self._last(drone_id, "armed")
 
     async def last_in_air(self, drone_id: str = "default"):
-        query = f'''
-        from(bucket: "{self.bucket}")
-          |> range(start: -24h)
-          |> filter(fn: (r) => r["_measurement"] == "in_air")
-          |> filter(fn: (r) => r["drone_id"] == "{drone_id}")
-          |> last()
-        '''
-
-        result = self.query_api.query(org=self.org, query=query)
-        for table in result:
-            for record in table.records:
-                return {
-                    'time': record.get_time(),
-                    'in_air': record.get_value()
-                }
-        return None
-
-    async def store_armed(self, armed: bool, drone_id: str = "default"):
+        return await self._last(drone_id, "in_air")
+
+    @staticmethod
+    def _state(measurement: str, row: dict) -> dict:
+        """A stored row in the shape the API returns."""
+        state = {'time': row['time']}
+        for field, key in FLEET_FIELDS[measurement].items():
+            state[key] = row.get(field)
+        return state
+
+    async def _last(self, drone_id: str, measurement: str):
+        found, value = self.last_state.lookup(drone_id, measurement)
+        if found:
+            return value
+
+        start = datetime.now(timezone.utc) - timedelta(hours=24)
+        done, row = await self._query(
+            ("last", measurement, drone_id), drone_id,
+            self.backend.last, measurement, drone_id, start)
+        if not done:
+            return None
+        value = self._state(measurement, row) if row is not None else None
+        self.last_state.put(drone_id, measurement, value)
+        return value
+
+    async def fleet_last(self, max_age: float = None) -> dict:
+        """Latest state of every drone, keyed by drone id.
+
+        Served from the last-state cache. The first call loads the whole
+        fleet with one grouped ``last()`` query instead of five queries per
+        drone. With ``max_age`` drones whose newest value is older than that
+        many seconds are left out.
+        """
+        if not self._fleet_loaded:
+            await self._load_fleet()
+
+        cutoff = None
+        if max_age is not None:
+            cutoff = datetime.now(timezone.utc).timestamp() - max_age
+
+        fleet = {}
+        for drone_id in self.last_state.drones():
+            state = self.last_state.snapshot(drone_id)
+            if not state:
+                continue
+            newest = max(value['time'] for value in state.values())
+            if cutoff is not None and newest.timestamp() < cutoff:
+                continue
+            fleet[drone_id] = {
+                measurement: state.get(measurement)
+                for measurement in FLEET_FIELDS
+            }
+        return fleet
+
+    async def _load_fleet(self):
+        start = datetime.now(timezone.utc) - timedelta(hours=24)
+        done, rows = await self._query(
+            ("last_per_drone",), None,
+            self.backend.last_per_drone, list(FLEET_FIELDS), start)
+        if not done:
+            return
+
+        for drone_id, measurement, row in rows:
+            self.last_state.put(drone_id, measurement,
+                                self._state(measurement, row))
+        self._fleet_loaded = True
+
+    async def store_armed(self, armed: bool, drone_id: str = "default",
+                          time: datetime = None):
         """Store armed change state"""
-        point = Point("armed") \
-            .tag("drone_id", drone_id) \
-            .field("armed", armed)
-
-        self.buffer.append(point)
-        await self._check_flush()
+        self._add_armed(armed, drone_id, time)
+        self._check_flush()
 
-    async def store_in_air(self, in_air: bool, drone_id: str = "default"):
+    async def store_in_air(self, in_air: bool, drone_id: str = "default",
+                           time: datetime = None):
         """Store in_air change state"""
-        point = Point("in_air") \
-            .tag("drone_id", drone_id) \
-            .field("in_air", in_air)
+        self._add_in_air(in_air, drone_id, time)
+        self._check_flush()
 
-        self.buffer.append(point)
-        await self._check_flush()
-
-    async def store_position(self, lat: float, lon: float, alt: float, drone_id: str = "default"):
+    async def store_position(self, lat: float, lon: float, alt: float,
+                             drone_id: str = "default", time: datetime = None):
         """Store position data with automatic batching."""
-        point = Point("position") \
-            .tag("drone_id", drone_id) \
-            .field("latitude", lat) \
-            .field("longitude", lon) \
-            .field("altitude", alt) \
-            .time(datetime.utcnow())
-
-        self.buffer.append(point)
-        await self._check_flush()
+        self._add_position(lat, lon, alt, drone_id, time)
+        self._check_flush()
 
     async def store_battery(self, battery_id: int, percent: float,
-                            drone_id: str = "default"):
+                            drone_id: str = "default", time: datetime = None):
         """Store battery telemetry."""
-        point = Point("battery") \
-            .tag("drone_id", drone_id) \
-            .tag("battery_id", str(battery_id)) \
-            .field("remaining_percent", percent) \
-            .time(datetime.utcnow())
+        self._add_battery(battery_id, percent, drone_id, time)
+        self._check_flush()
 
-        self.buffer.append(point)
-        await self._check_flush()
-
-    async def store_flight_mode(self, mode: str, drone_id: str = "default"):
+    async def store_flight_mode(self, mode: str, drone_id: str = "default",
+                                time: datetime = None):
         """Store flight mode changes."""
-        point = Point("flight_mode") \
-            .tag("drone_id", drone_id) \
-            .field("mode", mode) \
-            .time(datetime.utcnow())
-
-        self.buffer.append(point)
-        await self._check_flush()
-
-    async def _check_flush(self):
-        """Flush buffer if size or time threshold is reached."""
-        time_since_flush = (datetime.now() - self.last_flush).seconds
-
-        if len(self.buffer) >= self.buffer_size or time_since_flush >= self.flush_interval:
-            await self.flush()
-
-    async def flush(self):
-        """Write buffered data to InfluxDB."""
-        if self.buffer:
+        self._add_flight_mode(mode, drone_id, time)
+        self._check_flush()
+
+    async def store_message(self, data: dict, drone_id: str = "default") -> bool:
+        """Store a raw telemetry message as sent by the client.
+
+        Returns ``False`` when the message type is not known.
+        """
+        stored = self._add_message(data, drone_id)
+        self._check_flush()
+        return stored
+
+    async def store_batch(self, messages: list, drone_id: str = "default") -> list:
+        """Store many raw telemetry messages with a single flush check.
+
+        Returns one status dict per message, in order.
+        """
+        statuses = []
+        for data in messages:
+            if not isinstance(data, dict) or 'type' not in data:
+                statuses.append({"error": "Invalid telemetry data"})
+                continue
+            try:
+                if self._add_message(data, drone_id):
+                    statuses.append({"status": "received"})
+                else:
+                    statuses.append({"error": "Unknown telemetry type"})
+            except (KeyError, TypeError, ValueError) as e:
+                statuses.append({"error": f"Invalid telemetry data: {e}"})
+        self._check_flush()
+        return statuses
+
+    def _add_message(self, data: dict, drone_id: str) -> bool:
+        drone_id = data.get('drone_id', drone_id)
+        if not isinstance(drone_id, str):
+            raise ValueError(f"Invalid drone_id: {drone_id!r}")
+        time = parse_time(data.get('time'))
+
+        if data['type'] == 'position':
+            pos_data = data['data']
+            self._add_position(
+                lat=float(pos_data['latitude_deg']),
+                lon=float(pos_data['longitude_deg']),
+                alt=float(pos_data['relative_altitude_m']),
+                drone_id=drone_id,
+                time=time
+            )
+        elif data['type'] == 'battery':
+            bat_data = data['data']
+            self._add_battery(
+                battery_id=bat_data['id'],
+                percent=float(bat_data['remaining_percent']),
+                drone_id=drone_id,
+                time=time
+            )
+        elif data['type'] == 'flight_mode':
+            mode = data['data']['mode']
+            if not isinstance(mode, str):
+                raise ValueError(f"Invalid flight mode: {mode!r}")
+            self._add_flight_mode(mode, drone_id, time)
+        elif data['type'] == 'armed':
+            self._add_armed(_flag(data['armed']), drone_id, time)
+        elif data['type'] == 'in_air':
+            self._add_in_air(_flag(data['in_air']), drone_id, time)
+        else:
+            return False
+        return True
+
+    def _add_armed(self, armed: bool, drone_id: str, time: datetime = None):
+        time = time or datetime.now(timezone.utc)
+        sample = Sample("armed", drone_id, time, {"armed": armed})
+
+        self._append(sample)
+        self._remember(drone_id, "armed", {
+            'time': time,
+            'armed': armed
+        })
+
+    def _add_in_air(self, in_air: bool, drone_id: str, time: datetime = None):
+        time = time or datetime.now(timezone.utc)
+        sample = Sample("in_air", drone_id, time, {"in_air": in_air})
+
+        self._append(sample)
+        self._remember(drone_id, "in_air", {
+            'time': time,
+            'in_air': in_air
+        })
+
+    def _add_position(self, lat: float, lon: float, alt: float,
+                      drone_id: str, time: datetime = None):
+        time = time or datetime.now(timezone.utc)
+        sample = Sample("position", drone_id, time, {
+            "latitude": lat,
+            "longitude": lon,
+            "altitude": alt
+        })
+
+        self._append(sample)
+        self.recent_grid.insert(drone_id, time, lat, lon, alt)
+        self._remember(drone_id, "position", {
+            'time': time,
+            'latitude': lat,
+            'longitude': lon,
+            'altitude': alt
+        })
+
+    def _add_battery(self, battery_id: int, percent: float,
+                     drone_id: str, time: datetime = None):
+        time = time or datetime.now(timezone.utc)
+        sample = Sample("battery", drone_id, time,
+                        {"remaining_percent": percent},
+                        {"battery_id": str(battery_id)})
+
+        self._append(sample)
+        self._remember(drone_id, "battery", {
+            'time': time,
+            'percentage': percent
+        })
+
+    def _add_flight_mode(self, mode: str, drone_id: str, time: datetime = None):
+        time = time or datetime.now(timezone.utc)
+        sample = Sample("flight_mode", drone_id, time, {"mode": mode})
+
+        self._append(sample)
+        self._remember(drone_id, "flight_mode", {
+            'time': time,
+            'mode': mode
+        })
+
+    def _remember(self, drone_id: str, measurement: str, value: dict):
+        """Cache ``value`` as the latest state and push it to subscribers.
+
+        Backfilled points older than the current state are stored but not
+        pushed, dashboards only show the latest state.
+        """
+        if self.last_state.put(drone_id, measurement, value):
+            self.broker.publish(drone_id, "telemetry", {measurement: value})
+        self.points_received.inc((measurement, drone_id))
+
+    async def _query(self, key, drone_id, read, *args):
+        """Run a backend read on the query pool, through the cache.
+
+        Returns ``(done, result)``; ``done`` is false if it took longer
+        than ``query_timeout``. The read keeps its pool thread until the
+        backend answers.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            self.query_executor, self._cached, key, drone_id, read, *args)
+        try:
+            return True, await asyncio.wait_for(future, self.query_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Telemetry query %s timed out after %ss",
+                           read.__name__, self.query_timeout)
+            self.query_timeouts.inc((read.__name__,))
+            return False, None
+
+    def _cached(self, key, drone_id, read, *args, extend=None):
+        return self.cache.get(key, drone_id,
+                              lambda: self._timed(read, *args), extend)
+
+    def _timed(self, read, *args, **kwargs):
+        with self.query_seconds.time((read.__name__,)):
+            return read(*args, **kwargs)
+
+    def _append(self, sample: Sample):
+        with self._buffer_lock:
+            if len(self.buffer) == self.max_buffer:
+                self.dropped_points += 1
+            self.buffer.append(sample)
+
+    def _check_flush(self):
+        """Wake the flusher early if the size threshold is reached."""
+        if len(self.buffer) >= self.buffer_size \
+                and time.monotonic() >= self._retry_at:
+            self._wake.set()
+
+    def _run_flusher(self):
+        while not self._closing:
+            self._wake.wait(max(self.flush_interval,
+                                self._retry_at - time.monotonic()))
+            self._wake.clear()
+            self.flush()
+            self.recent_grid.prune()
+            self.backend.prune()
+
+    def flush(self) -> bool:
+        """Write buffered data to the backend.
+
+        On failure the points go back to the front of the buffer to be
+        retried on the next flush, unless the backend refused them for
+        good.
+        """
+        with self._flush_lock:
+            with self._buffer_lock:
+                points = self.buffer
+                self.buffer = deque(maxlen=self.max_buffer)
+            if not points:
+                return True
+            start = time.perf_counter()
             try:
-                self.write_api.write(bucket=self.bucket, org=self.org,
-                                     record=self.buffer)
-                self.buffer = []
-                self.last_flush = datetime.now()
+                self.backend.write(list(points))
+            except RejectedWrite as e:
+                logger.error("Dropped %d telemetry points: %s",
+                             len(points), e)
+                self.flush_failures += 1
+                self.rejected_points += len(points)
+                return False
             except Exception as e:
-                print(f"Error writing to InfluxDB: {e}")
+                logger.error("Error writing telemetry: %s", e)
+                self.flush_failures += 1
+                self._backoff = min(max(self._backoff * 2,
+                                        self.flush_interval),
+                                    MAX_FLUSH_BACKOFF)
+                self._retry_at = time.monotonic() + self._backoff
+                with self._buffer_lock:
+                    overflow = len(points) + len(self.buffer) - self.max_buffer
+                    points.extend(self.buffer)
+                    self.buffer = points
+                    self.dropped_points += max(overflow, 0)
+                return False
+            self._backoff = 0
+            self._retry_at = 0
+            self.cache.touch({point.drone_id for point in points})
+            self.flush_seconds.observe(time.perf_counter() - start)
+            self.flush_points.observe(len(points))
+            self.last_flush = time.monotonic()
+            self.last_flush_size = len(points)
+            return True
+
+    def _recent_positions(self, minutes: int, drone_id: str,
+                          max_points: int, resolution: int,
+                          since: datetime, desc: bool) -> list:
+        window = resolution
+        if since is not None:
+            # Windows are stamped with their end, which can be later than
+            # the newest point in them: a cursor taken from one would skip
+            # points stored later in that window. Increments stay raw.
+            window = None
+        elif max_points:
+            oversampled = max_points * self.track_oversample
+            window = max(window or 0, -(-minutes * 60 // oversampled))
+        rows = self._read_positions(minutes, drone_id, window, since, desc)
+        while rows and max_points and window and window != resolution \
+                and len(rows) < max_points:
+            # The points only cover part of the range, size the window on
+            # their span instead. Rows are stamped with their window's end
+            span = abs(rows[-1]['time'] - rows[0]['time']).total_seconds()
+            finer = max(resolution or 0, int((span + window) // oversampled))
+            if finer >= window:
+                break
+            window = finer
+            rows = self._read_positions(minutes, drone_id, window, since, desc)
+        return rows
+
+    def _read_positions(self, minutes: int, drone_id: str, window: int,
+                        since: datetime, desc: bool) -> list:
+        start = datetime.now(timezone.utc) - timedelta(minutes=minutes)
+        rows = self._cached(
+            ("positions", drone_id, minutes, window), drone_id,
+            self.backend.positions, drone_id, start, None, window,
+            extend=lambda rows: self._extend_positions(
+                rows, drone_id, start, window))
+        if since is not None and since >= start:
+            rows = rows[bisect_right(rows, since, key=_time):]
+        else:
+            # A cursor older than the range gets the whole range, never more
+            rows = _trim(rows, start, window)
+        return rows[::-1] if desc else rows
+
+    def _extend_positions(self, rows: list, drone_id: str,
+                          start: datetime, window: int) -> list:
+        """Cached position rows followed by the ones stored since."""
+        rows = _trim(rows, start, window)
+        if not rows:
+            return self._timed(self.backend.positions, drone_id, start,
+                               window=window)
+        last = rows[-1]['time']
+        if window:
+            # The newest window may have gained points, read it again
+            rows = rows[:-1]
+            newer = self._timed(self.backend.positions, drone_id,
+                                last - timedelta(seconds=window),
+                                window=window)
+        else:
+            newer = self._timed(self.backend.positions, drone_id, last,
+                                after=last)
+        return rows + newer
 
     def query_recent_positions(self, minutes: int = 10,
-                               drone_id: str = "default") -> list:
-        """Query recent positions for analysis."""
-        query_api = self.client.query_api()
-
-        query = f'''
-        from(bucket: "{self.bucket}")
-          |> range(start: -{minutes}m)
-          |> filter(fn: (r) => r["_measurement"] == "position")
-          |> filter(fn: (r) => r["drone_id"] == "{drone_id}")
-          |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")
-          |> sort(columns: ["_time"], desc: true)
-        '''
-
-        result = query_api.query(org=self.org, query=query)
-        positions = []
-
-        for table in result:
-            for record in table.records:
-                positions.append({
-                    'time': record.get_time(),
-                    'latitude': record.values.get('latitude'),
-                    'longitude': record.values.get('longitude'),
-                    'altitude': record.values.get('altitude')
-                })
-
+                               drone_id: str = "default",
+                               max_points: int = None,
+                               resolution: int = None,
+                               since: datetime = None) -> list:
+        """Query recent positions for analysis.
+
+        ``resolution`` keeps the last point of every window of that many
+        seconds. ``max_points`` picks a window that leaves a few times that
+        many points and then simplifies the track down to ``max_points``.
+        With ``since`` only points strictly newer than it are returned, not
+        downsampled to windows, so the newest one is a valid next cursor.
+        """
+        positions = [{
+            'time': row['time'],
+            'latitude': row.get('latitude'),
+            'longitude': row.get('longitude'),
+            'altitude': row.get('altitude')
+        } for row in self._recent_positions(
+            minutes, drone_id, max_points, resolution, since, desc=True)]
+
+        if max_points:
+            positions = simplify_track(positions, max_points)
         return positions
 
+    def query_recent_track(self, minutes: int = 10,
+                           drone_id: str = "default",
+                           max_points: int = None,
+                           resolution: int = None,
+                           since: datetime = None) -> dict:
+        """Same as ``query_recent_positions`` in the compact track encoding.
+
+        Columns are filled from the row dicts ``StorageBackend.positions``
+        returns, oldest first. Those rows are built once per backend read
+        and shared through the query cache by every track and JSON request
+        on the same range, so no per-request objects are made besides the
+        columns. ``cursor`` holds the exact time of the newest stored
+        point, or ``since`` when nothing newer came back.
+        """
+        newest = None
+        if since is None and (resolution or max_points):
+            # Downsampled rows carry window end stamps, take the cursor from
+            # the newest raw point. Read first: a flush in between repeats
+            # points on the next increment instead of skipping them
+            start = datetime.now(timezone.utc) - timedelta(minutes=minutes)
+            newest = self._cached(
+                ("last", "position", drone_id, minutes), drone_id,
+                self.backend.last, "position", drone_id, start)
+        times, lats, lons, alts = [], [], [], []
+        for row in self._recent_positions(
+                minutes, drone_id, max_points, resolution, since, desc=False):
+            times.append(row['time'])
+            lats.append(row.get('latitude'))
+            lons.append(row.get('longitude'))
+            alts.append(row.get('altitude'))
+
+        if max_points and len(times) > max_points:
+            keep = simplify_indices(
+                [(lon or 0.0, lat or 0.0) for lat, lon in zip(lats, lons)],
+                max_points)
+            times = [times[i] for i in keep]
+            lats = [lats[i] for i in keep]
+            lons = [lons[i] for i in keep]
+            alts = [alts[i] for i in keep]
+
+        encoded = encode_track(times, lats, lons, alts)
+        last = times[-1] if times else since
+        if times and newest is not None:
+            last = newest['time']
+        encoded["cursor"] = format_time(last) if last else None
+        return encoded
+
     def query_positions_in_area(self, min_lat: float, max_lat: float,
                                 min_lon: float, max_lon: float,
-                                hours: int = 24) -> list:
-        """Query positions within a geographic bounding box."""
-        query_api = self.client.query_api()
-
-        query = f'''
-        from(bucket: "{self.bucket}")
-          |> range(start: -{hours}h)
-          |> filter(fn: (r) => r["_measurement"] == "position")
-          |> filter(fn: (r) => r["_field"] == "latitude" or 
-                              r["_field"] == "longitude" or 
-                              r["_field"] == "altitude")
-          |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")
-          |> filter(fn: (r) => r.latitude >= {min_lat} and r.latitude <= {max_lat})
-          |> filter(fn: (r) => r.longitude >= {min_lon} and r.longitude <= {max_lon})
-          |> sort(columns: ["_time"], desc: true)
-        '''
-
-        result = query_api.query(org=self.org, query=query)
-        positions = []
-
-        for table in result:
-            for record in table.records:
-                positions.append({
-                    'time': record.get_time(),
-                    'latitude': record.values.get('latitude'),
-                    'longitude': record.values.get('longitude'),
-                    'altitude': record.values.get('altitude')
-                })
-
-        return positions
-
-    async def close(self, e=None):
-        """Clean up resources."""
-        await self.flush()
-        self.client.close()
+                                hours: float = 24) -> list:
+        """Query positions within a geographic bounding box.
+
+        Windows the in-memory grid fully covers are answered from it,
+        longer ones by the backend.
+        """
+        if self.recent_grid.covers(hours * 3600):
+            return self.recent_grid.query(min_lat, max_lat,
+                                          min_lon, max_lon, hours * 3600)
+
+        start = datetime.now(timezone.utc) - timedelta(hours=hours)
+        return [{
+            'time': row['time'],
+            'drone_id': row.get('drone_id'),
+            'latitude': row.get('latitude'),
+            'longitude': row.get('longitude'),
+            'altitude': row.get('altitude')
+        } for row in self._cached(
+            ("positions_in_area", min_lat, max_lat, min_lon, max_lon, hours),
+            None, self.backend.positions_in_area,
+            min_lat, max_lat, min_lon, max_lon, start)]
+
+    def export(self, drone_id: str, measurements: list,
+               start: datetime, end: datetime):
+        """Iterate stored ``(measurement, row)`` from ``start`` up to ``end``.
+
+        The range is read one ``export_window`` at a time, so neither this
+        process nor the backend holds more than a window of rows.
+        """
+        step = timedelta(seconds=self.export_window)
+        while start < end:
+            stop = min(start + step, end)
+            yield from self.backend.export(drone_id, measurements,
+                                           start, stop)
+            start = stop
+
+    def close(self):
+        """Stop the flusher, drain the buffer and clean up resources."""
+        self._closing = True
+        self._wake.set()
+        self._flusher.join()
+        self.flush()
+        self.query_executor.shutdown(wait=False)
+        self.backend.close()
@@ -0,0 +1,36 @@
+MIMETYPE = "application/vnd.cherum.track+json"
+
+TIME_SCALE = 1000  # milliseconds
+LATLON_SCALE = 1_000_000  # six decimals, about 11 cm
+ALTITUDE_SCALE = 100  # centimetres
+
+
+def _deltas(values: list) -> list:
+    out = []
+    last = 0
+    for value in values:
+        out.append(value - last)
+        last = value
+    return out
+
+
+def encode_track(times: list, lats: list, lons: list, alts: list) -> dict:
+    """Encode track columns as delta-coded fixed-point integer arrays.
+
+    Each column starts with an absolute value followed by differences to
+    the previous point, so a steady track becomes runs of small numbers
+    instead of one JSON object per point. ``times`` are aware datetimes in
+    ascending order.
+    """
+    return {
+        "count": len(times),
+        "scale": {
+            "time": TIME_SCALE,
+            "latlon": LATLON_SCALE,
+            "altitude": ALTITUDE_SCALE
+        },
+        "time": _deltas([round(t.timestamp() * TIME_SCALE) for t in times]),
+        "latitude": _deltas([round((v or 0) * LATLON_SCALE) for v in lats]),
+        "longitude": _deltas([round((v or 0) * LATLON_SCALE) for v in lons]),
+        "altitude": _deltas([round((v or 0) * ALTITUDE_SCALE) for v in alts])
+    }